@@ -1,8 +1,29 @@
 import os
+import json
 import hashlib
+import threading
 
 CHUNK_SIZE = 64 * 1024  # 64KB por padrão
 
+# Nome e tamanho de um arquivo anunciado, guardados junto dos chunks para
+# que o peer consiga registrá-lo de novo no tracker
+FILE_INFO = "info.json"
+
+def is_file_hash(value) -> bool:
+    # sha256 em hex, como sai de hash_file
+    return isinstance(value, str) and len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+def file_chunk_dir(base_dir, file_hash):
+    # Diretório de chunks de um arquivo pedido por outro peer, ou None se o
+    # hash é inválido ou o caminho (seguindo links) sai de base_dir
+    if not is_file_hash(file_hash):
+        return None
+    chunk_dir = os.path.join(base_dir, file_hash)
+    real_base = os.path.realpath(base_dir)
+    if os.path.commonpath([real_base, os.path.realpath(chunk_dir)]) != real_base:
+        return None
+    return chunk_dir
+
 def hash_file(filepath):
     sha = hashlib.sha256()
     with open(filepath, 'rb') as f:
@@ -11,6 +32,74 @@ def hash_file(filepath):
     return sha.hexdigest()
 
 
+class ChunkIndex:
+    # Chunks em disco por diretório de arquivo: {chunk_dir: {índice: (caminho,
+    # tamanho, hash)}}. O hash vem do nome do chunk ("{índice}_{sha256}"),
+    # conferido quando o chunk foi gerado ou baixado. Cada diretório é lido
+    # uma vez só; depois quem grava chunks avisa com add(). Diretórios que
+    # não existem não ficam no cache.
+    def __init__(self):
+        self._dirs = {}
+        self._lock = threading.Lock()
+
+    def _scan(self, chunk_dir):
+        chunks = {}
+        try:
+            entries = list(os.scandir(chunk_dir))
+        except OSError:
+            return chunks
+        for entry in entries:
+            index_str, sep, chunk_hash = entry.name.partition("_")
+            # Também pula temporários ("temp_3") e info.json
+            if not sep or not index_str.isdigit() or not entry.is_file():
+                continue
+            chunks[int(index_str)] = (entry.path, entry.stat().st_size, chunk_hash)
+        return chunks
+
+    def _chunks(self, chunk_dir):
+        chunk_dir = os.path.abspath(os.path.expanduser(chunk_dir))
+        chunks = self._dirs.get(chunk_dir)
+        if chunks is None:
+            chunks = self._scan(chunk_dir)
+            if chunks or os.path.isdir(chunk_dir):
+                self._dirs[chunk_dir] = chunks
+        return chunks
+
+    def cached(self, chunk_dir):
+        # Se False, a próxima consulta lê o diretório do disco
+        with self._lock:
+            return os.path.abspath(os.path.expanduser(chunk_dir)) in self._dirs
+
+    def load(self, base_dir):
+        # Carrega de uma vez todos os arquivos de um peer (na subida do servidor)
+        base_dir = os.path.expanduser(base_dir)
+        if not os.path.isdir(base_dir):
+            return
+        with self._lock:
+            for entry in os.scandir(base_dir):
+                if entry.is_dir():
+                    self._chunks(entry.path)
+
+    def add(self, chunk_dir, index, path, size, chunk_hash):
+        with self._lock:
+            self._chunks(chunk_dir)[index] = (path, size, chunk_hash)
+
+    def discard(self, chunk_dir, index):
+        with self._lock:
+            self._chunks(chunk_dir).pop(index, None)
+
+    def get(self, chunk_dir, index):
+        with self._lock:
+            return self._chunks(chunk_dir).get(index)
+
+    def indexes(self, chunk_dir):
+        with self._lock:
+            return sorted(self._chunks(chunk_dir))
+
+
+local_chunks = ChunkIndex()
+
+
 def split_file(filepath, chunk_dir, chunk_size=CHUNK_SIZE):
     chunk_dir = os.path.expanduser(chunk_dir)
     os.makedirs(chunk_dir, exist_ok=True)
@@ -25,6 +114,7 @@ def split_file(filepath, chunk_dir, chunk_size=CHUNK_SIZE):
 
             with open(chunk_path, 'wb') as cf:
                 cf.write(data)
+            local_chunks.add(chunk_dir, index, chunk_path, len(data), sha)
 
             chunks.append({"index": index, "hash": sha})
             index += 1
@@ -83,18 +173,67 @@ def reassemble_file(chunk_dir, output_path):
 
 
 def get_chunks_available(chunk_dir: str, file_hash: str) -> list[int]:
-    file_chunk_dir = os.path.join(chunk_dir, file_hash)
-    if not os.path.isdir(file_chunk_dir):
+    file_dir = file_chunk_dir(chunk_dir, file_hash)
+    return local_chunks.indexes(file_dir) if file_dir else []
+
+
+# Bitfield de chunks: bit i (do mais significativo para o menos, byte a byte)
+# indica que o peer tem o chunk i
+def encode_bitfield(indexes, num_chunks) -> bytes:
+    bitfield = bytearray((num_chunks + 7) // 8)
+    for i in indexes:
+        if 0 <= i < num_chunks:
+            bitfield[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(bitfield)
+
+
+def decode_bitfield(bitfield: bytes, num_chunks) -> list[int]:
+    return [
+        i for i in range(min(num_chunks, len(bitfield) * 8))
+        if bitfield[i >> 3] & (0x80 >> (i & 7))
+    ]
+
+
+def merge_bitfield(bitfield: bytes, indexes, num_chunks) -> bytes:
+    merged = bytearray(bitfield.ljust((num_chunks + 7) // 8, b"\0"))
+    for i in indexes:
+        if 0 <= i < num_chunks:
+            merged[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(merged)
+
+
+# Digest do conjunto de arquivos de um peer: XOR de 128 bits do sha256 de
+# cada hash. Não depende da ordem e pode ser atualizado um arquivo por vez
+# (digest anterior + hashes novos).
+def holdings_digest(file_hashes, digest=None) -> str:
+    value = int(digest, 16) if digest else 0
+    for file_hash in file_hashes:
+        value ^= int.from_bytes(hashlib.sha256(file_hash.encode()).digest()[:16], "big")
+    return f"{value:032x}"
+
+
+def save_file_info(chunk_dir, filename, size):
+    with open(os.path.join(chunk_dir, FILE_INFO), "w") as f:
+        json.dump({"filename": filename, "size": size}, f)
+
+
+def list_holdings(base_dir) -> list[str]:
+    # Hashes dos arquivos que este peer anunciou (os baixados só têm chunks)
+    if not os.path.isdir(base_dir):
         return []
+    return [
+        entry.name for entry in os.scandir(base_dir)
+        if entry.is_dir() and os.path.exists(os.path.join(entry.path, FILE_INFO))
+    ]
 
-    chunks = []
-    for fname in os.listdir(file_chunk_dir):
-        if "_" not in fname:
-            continue
+
+def load_holdings(base_dir) -> list[dict]:
+    files = []
+    for file_hash in list_holdings(base_dir):
         try:
-            index_str, _ = fname.split("_", 1)
-            idx = int(index_str)
-            chunks.append(idx)
-        except ValueError:
+            with open(os.path.join(base_dir, file_hash, FILE_INFO)) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
             continue
-    return sorted(chunks)
+        files.append({"hash": file_hash, "filename": info["filename"], "size": info["size"]})
+    return files
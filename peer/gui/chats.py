@@ -1,5 +1,4 @@
 import datetime
-import json
 import queue
 import socket
 import tkinter as tk
@@ -8,7 +7,8 @@ import threading
 import time
 
 from peer.chat import store_message
-from peer.gui.utils import send_request
+from peer.gui.utils import send_request, subscribe_events, unsubscribe_events
+from peer.transport import request
 
 
 class ChatRoomWindow:
@@ -64,9 +64,31 @@ class ChatRoomWindow:
             delete_room_btn = tk.Button(admin_frame, text="Remover Sala", command=self.delete_room)
             delete_room_btn.pack(side=tk.LEFT)
 
+        subscribe_events(self.token, self.on_tracker_event, self.window)
         threading.Thread(target=self.fetch_history_and_members, daemon=True).start()
         self.check_queue()
 
+    def on_tracker_event(self, event):
+        # Entradas e saídas de membros e de peers chegam do tracker; a lista
+        # de membros é atualizada localmente
+        name = event.get("event")
+        if name == "resync":
+            threading.Thread(target=self.fetch_members, daemon=True).start()
+        elif name in ("peer_online", "peer_offline"):
+            address = event.get("address")
+            self.members = [{**m, "address": address} if m['username'] == event["username"] else m for m in self.members]
+        elif event.get("room_id") != self.room_id:
+            return
+        elif name == "room_member_added":
+            self.members = [m for m in self.members if m['username'] != event["username"]]
+            self.members.append({"username": event["username"], "address": event["address"]})
+        elif name == "room_member_removed":
+            self.members = [m for m in self.members if m['username'] != event["username"]]
+            if event["username"] == self.username:
+                self.msg_queue.put({"sender": "SISTEMA", "content": "Você foi removido da sala.", "timestamp": time.time()})
+        elif name == "room_deleted":
+            self.msg_queue.put({"sender": "SISTEMA", "content": "A sala foi removida pelo moderador.", "timestamp": time.time()})
+
     def setup_menu(self):
         menu_bar = tk.Menu(self.window)
         self.window.config(menu=menu_bar)
@@ -83,11 +105,9 @@ class ChatRoomWindow:
 
         user_listbox = tk.Listbox(window)
         user_listbox.pack(padx=10, pady=5, fill='both', expand=True)
+        user_listbox.users_data = []
 
-        def refresh_users():
-            res = send_request({"type": "list_active_peers", "token": self.token})
-            active_peers = res.get("peers", [])
-
+        def render_users(active_peers):
             current_members = [m['username'] for m in self.members]
             candidates = [u for u in active_peers if
                           u['username'] != self.username and u['username'] not in current_members]
@@ -98,6 +118,30 @@ class ChatRoomWindow:
             for user in candidates:
                 user_listbox.insert(tk.END, f"{user['username']} ({user.get('address', 'Offline')})")
 
+        def fetch_users():
+            res = send_request({"type": "list_active_peers", "token": self.token})
+            active_peers = res.get("peers", [])
+            window.after(0, lambda: window.winfo_exists() and render_users(active_peers))
+
+        def refresh_users():
+            threading.Thread(target=fetch_users, daemon=True).start()
+
+        def on_peer_event(event):
+            if event.get("event") == "resync":
+                refresh_users()
+            elif event.get("topic") == "peers":
+                candidates = [u for u in user_listbox.users_data if u['username'] != event["username"]]
+                if event["event"] == "peer_online":
+                    candidates.append({"username": event["username"], "address": event["address"]})
+                render_users(candidates)
+
+        def on_destroy(event):
+            if event.widget is window:
+                unsubscribe_events(on_peer_event)
+
+        subscribe_events(self.token, on_peer_event, window)
+        window.bind("<Destroy>", on_destroy)
+
         def confirm_add():
             selected = user_listbox.curselection()
             if not selected:
@@ -115,7 +159,6 @@ class ChatRoomWindow:
 
             if res.get('status') == 'success':
                 messagebox.showinfo("Adicionar Membro", res.get("message"), parent=window)
-                self.fetch_history_and_members()
                 window.destroy()
             else:
                 messagebox.showerror("Erro", res.get("message", "Erro ao adicionar membro."), parent=window)
@@ -156,7 +199,7 @@ class ChatRoomWindow:
         res = send_request(payload)
         if res.get("status") == "success":
             messagebox.showinfo("Sala Removida", res.get("message"), parent=self.window)
-            self.window.destroy()
+            self.on_closing()
         else:
             messagebox.showerror("Erro", res.get("message"), parent=self.window)
 
@@ -164,11 +207,16 @@ class ChatRoomWindow:
         member_names = [f"- {m['username']} {'(Online)' if m['address'] else '(Offline)'}" for m in self.members]
         messagebox.showinfo("Membros da Sala", "\n".join(member_names), parent=self.window)
 
-    def fetch_history_and_members(self):
+    def fetch_members(self):
         res = send_request({"type": "get_chat_members", "token": self.token, "room_id": self.room_id})
-        if res.get('status') != 'success': self.display_message(
-            {"sender": "SISTEMA", "content": "Erro ao buscar lista de membros.", "timestamp": time.time()}); return
+        if res.get('status') != 'success':
+            return False
         self.members = res.get('members', [])
+        return True
+
+    def fetch_history_and_members(self):
+        if not self.fetch_members(): self.display_message(
+            {"sender": "SISTEMA", "content": "Erro ao buscar lista de membros.", "timestamp": time.time()}); return
         moderator_info = next((m for m in self.members if m['username'] == self.owner), None)
         if not moderator_info or not moderator_info['address']: self.display_message(
             {"sender": "SISTEMA", "content": "Moderador está offline. Histórico indisponível.",
@@ -179,8 +227,7 @@ class ChatRoomWindow:
                 s.settimeout(5)
                 s.connect((mod_host, int(mod_port)))
                 payload = {"type": "get_chat_history", "room_id": self.room_id}
-                s.sendall(json.dumps(payload).encode('utf-8'))
-                res = json.loads(s.recv(8192).decode('utf-8'))
+                res = request(s, payload)
                 if res['status'] == 'success':
                     for msg in res['history']: self.display_message(msg)
                 self.display_message({"sender": "SISTEMA", "content": "Você entrou na sala.", "timestamp": time.time()})
@@ -214,7 +261,7 @@ class ChatRoomWindow:
                 s.settimeout(2)
                 s.connect((host, int(port)))
                 payload = {"type": "broadcast_message", "room_id": self.room_id, "message": message_payload}
-                s.sendall(json.dumps(payload).encode('utf-8'))
+                request(s, payload)
         except Exception as e:
             print(f"Não foi possível enviar mensagem para {member['username']}: {e}")
 
@@ -236,4 +283,5 @@ class ChatRoomWindow:
     def on_closing(self):
         if self.room_id in self.message_queues:
             del self.message_queues[self.room_id]
+        unsubscribe_events(self.on_tracker_event)
         self.window.destroy()
\ No newline at end of file
@@ -5,9 +5,12 @@ import threading
 import time
 import os
 
-from peer.chunk_manager import split_file, hash_file
-from peer.gui.utils import send_request
-from peer.p2p_client import download_file
+from peer.chunk_manager import split_file, hash_file, save_file_info
+from peer.gui.utils import send_batch, send_request, subscribe_events, unsubscribe_events
+from peer.p2p_client import CHUNK_SIZE, chunk_holders_from_tracker, download_file
+
+LIST_PAGE_SIZE = 500
+FILE_PEERS_LIMIT = 20
 
 
 class FileManagerWindow(tk.Toplevel):
@@ -18,7 +21,10 @@ class FileManagerWindow(tk.Toplevel):
         self.token = token
         self.username = username
 
-        res = send_request({"type": "get_user_tier", "token": self.token})
+        res, first_page = send_batch(self.token, [
+            {"type": "get_user_tier"},
+            {"type": "list_files", "limit": LIST_PAGE_SIZE},
+        ])
         if res.get("status") == "success":
             self.tier = f"Tier {res.get('tier')}"
             self.max_connections = res.get("max_connections")
@@ -26,6 +32,9 @@ class FileManagerWindow(tk.Toplevel):
             self.tier = "Tier desconhecido"
 
         self.files_data = []
+        self.files_by_hash = {}
+        self.catalog_version = None
+        self.peer_addresses = {}
 
         login_status_label = tk.Label(self, text=f"Você está logado como: {self.username} ({self.tier})", font=("Arial", 9, "italic"),
                                       relief=tk.SUNKEN, anchor='w')
@@ -35,6 +44,10 @@ class FileManagerWindow(tk.Toplevel):
         top_frame.pack(pady=5, padx=10, fill='x')
         tk.Button(top_frame, text="Anunciar Novo Arquivo", command=self._announce_file_thread).pack(side='left')
         tk.Button(top_frame, text="Atualizar Lista", command=self._list_files_thread).pack(side='left', padx=5)
+        tk.Button(top_frame, text="Buscar", command=self._search_files_thread).pack(side='right')
+        self.search_entry = tk.Entry(top_frame)
+        self.search_entry.pack(side='right', padx=5)
+        self.search_entry.bind("<Return>", lambda event: self._search_files_thread())
 
         list_frame = tk.Frame(self)
         list_frame.pack(pady=5, padx=10, fill='both', expand=True)
@@ -54,7 +67,46 @@ class FileManagerWindow(tk.Toplevel):
         self.progress_bar = ttk.Progressbar(self, orient='horizontal', length=100, mode='determinate')
         self.progress_bar.pack(pady=5, padx=10, fill='x')
 
-        self._list_files_thread()
+        subscribe_events(self.token, self._on_event, self)
+        self.bind("<Destroy>", self._on_destroy)
+
+        self._list_files_thread(first_page if first_page.get("status") == "success" else None)
+
+    def _on_destroy(self, event):
+        if event.widget is self:
+            unsubscribe_events(self._on_event)
+
+    def _on_event(self, event):
+        # Mantém o catálogo local em dia com os eventos do tracker, sem
+        # baixar a lista de novo
+        name = event.get("event")
+        if name == "resync":
+            self._list_files_thread()
+            return
+        if name == "file_registered":
+            f = self.files_by_hash.setdefault(event["hash"], {
+                "filename": event["filename"], "size": event["size"], "hash": event["hash"], "peers_info": []
+            })
+            if all(p["username"] != event["username"] for p in f["peers_info"]):
+                f["peers_info"].append({"username": event["username"], "address": self.peer_addresses.get(event["username"])})
+        elif name == "file_removed":
+            self.files_by_hash.pop(event["hash"], None)
+        elif name == "peer_online":
+            self.peer_addresses[event["username"]] = event["address"]
+            for f in self.files_by_hash.values():
+                for p in f["peers_info"]:
+                    if p["username"] == event["username"]:
+                        p["address"] = event["address"]
+        elif name == "peer_offline":
+            # O tracker apaga os arquivos de quem saiu
+            self.peer_addresses.pop(event["username"], None)
+            for f in self.files_by_hash.values():
+                f["peers_info"] = [p for p in f["peers_info"] if p["username"] != event["username"]]
+        else:
+            return
+
+        self.files_data = [self.files_by_hash[h] for h in sorted(self.files_by_hash)]
+        self._render_files()
 
     def _on_file_select(self, event=None):
         selected_indices = self.files_listbox.curselection()
@@ -65,13 +117,67 @@ class FileManagerWindow(tk.Toplevel):
         details_text = f"Nome: {file_data['filename']}\nTamanho: {file_data['size']:,} bytes\nPeers: {online_peers}/{len(file_data['peers_info'])} online"
         self.details_label.config(text=details_text)
 
-    def _list_files_thread(self):
-        threading.Thread(target=self._list_files, daemon=True).start()
+    def _list_files_thread(self, first_page=None):
+        threading.Thread(target=self._list_files, args=(first_page,), daemon=True).start()
+
+    def _list_files(self, first_page=None):
+        # Busca o catálogo em páginas; depois da primeira carga pede só o que
+        # mudou desde a última versão vista
+        since_version = self.catalog_version
+        cursor = None
+        pages = []
+        while True:
+            payload = {"type": "list_files", "token": self.token, "limit": LIST_PAGE_SIZE}
+            if cursor:
+                payload["cursor"] = cursor
+            if since_version is not None:
+                payload["since_version"] = since_version
+            if first_page is not None:
+                res, first_page = first_page, None
+            else:
+                res = send_request(payload)
+            if res.get("status") != "success":
+                return
+            pages.append(res)
+
+            cursor = res.get("next_cursor")
+            if not cursor:
+                break
+
+        # files_by_hash também é alterado pelos eventos, na thread do Tk
+        self.after(0, self._apply_pages, since_version, pages)
+
+    def _apply_pages(self, since_version, pages):
+        first = pages[0]
+        if since_version is None or first.get("reset"):
+            self.files_by_hash = {}
+        for file_hash in first.get("removed", []):
+            self.files_by_hash.pop(file_hash, None)
+        for res in pages:
+            for f in res.get("files", []):
+                self.files_by_hash[f["hash"]] = f
 
-    def _list_files(self):
-        res = send_request({"type": "list_files", "token": self.token})
+        self.catalog_version = first.get("version")
+        self.files_data = [self.files_by_hash[h] for h in sorted(self.files_by_hash)]
+        self._render_files()
+
+    def _search_files_thread(self):
+        threading.Thread(target=self._search_files, args=(self.search_entry.get(),), daemon=True).start()
+
+    def _search_files(self, query):
+        if not query.strip():
+            self.files_data = [self.files_by_hash[h] for h in sorted(self.files_by_hash)]
+            self._render_files()
+            return
+
+        res = send_request({"type": "search_files", "token": self.token, "query": query})
+        if res.get("status") != "success":
+            messagebox.showerror("Erro", res.get("message", "Erro na busca."), parent=self)
+            return
         self.files_data = res.get("files", [])
+        self._render_files()
 
+    def _render_files(self):
         self.files_listbox.delete(0, tk.END)
         for f in self.files_data:
             name = f['filename'].ljust(40)
@@ -93,6 +199,7 @@ class FileManagerWindow(tk.Toplevel):
         file_hash = hash_file(filepath)
         chunk_dir = os.path.join(base_dir, file_hash)
         split_file(filepath, chunk_dir)
+        save_file_info(chunk_dir, os.path.basename(filepath), os.path.getsize(filepath))
 
         payload = {"type": "register_file", "token": self.token, "filename": os.path.basename(filepath),
                    "size": os.path.getsize(filepath), "hash": file_hash}
@@ -111,20 +218,42 @@ class FileManagerWindow(tk.Toplevel):
     def _download_file(self, file_data):
         file_hash, filename, total_size = file_data['hash'], file_data['filename'], file_data['size']
 
-        res = send_request({"type": "list_active_peers", "token": self.token})
-        if res["status"] != "success":
-            messagebox.showerror("Erro", res["message"])
-            return
+        res = send_request({"type": "get_file_peers", "token": self.token, "hash": file_hash, "limit": FILE_PEERS_LIMIT})
+        chunk_holders = None
+        usernames = {}
+        if res.get("status") == "success":
+            file_peers = res.get("peers", [])
+            usernames = {p["address"]: p["username"] for p in file_peers}
+            chunk_holders = chunk_holders_from_tracker(file_peers, total_size, self.username) or None
 
-        peers = res.get("peers", [])
+        peers = []
+        if chunk_holders is None:
+            res = send_request({"type": "list_active_peers", "token": self.token})
+            if res["status"] != "success":
+                messagebox.showerror("Erro", res["message"])
+                return
 
-        if not peers:
-            messagebox.showerror("Erro", "Nenhum peer ativo no momento.")
-            return
+            peers = res.get("peers", [])
+
+            if not peers:
+                messagebox.showerror("Erro", "Nenhum peer ativo no momento.")
+                return
+
+        num_chunks = (total_size + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+        def announce_chunks(indexes):
+            send_request({"type": "announce_chunks", "token": self.token, "hash": file_hash,
+                          "num_chunks": num_chunks, "have": indexes})
+
+        def report_transfers(stats):
+            transfers = [{"username": usernames[address], "bytes": num_bytes, "seconds": seconds}
+                         for address, (num_bytes, seconds) in stats.items() if address in usernames]
+            send_request({"type": "report_transfers", "token": self.token, "transfers": transfers})
 
         start_time = time.time()
         success = download_file(self.username, filename, file_hash, total_size,
-                                [peer["address"] for peer in peers if peer["username"] != self.username], self.max_connections)
+                                [peer["address"] for peer in peers if peer["username"] != self.username], self.max_connections,
+                                chunk_holders=chunk_holders, on_chunks=announce_chunks, on_transfer_stats=report_transfers)
         print("Download took %.3f seconds." % (time.time() - start_time))
         if success:
             messagebox.showinfo("Download", f"Arquivo {filename} baixado com sucesso.")
@@ -11,7 +11,8 @@ if project_root not in sys.path:
 
 from peer.gui.chats import ChatRoomWindow
 from peer.gui.files import FileManagerWindow
-from peer.gui.utils import hash_password, send_request
+from peer.gui.utils import hash_password, send_request, subscribe_events, unsubscribe_events
+from peer.chunk_manager import holdings_digest, list_holdings, load_holdings, local_chunks, save_file_info
 from peer.p2p_server import start_p2p_server
 
 
@@ -101,13 +102,56 @@ class P2PClientApp:
     def start_background_services(self):
         self.p2p_port = start_p2p_server(self.username, self.messages_queues)
         threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+        subscribe_events(self.token, self.on_tracker_event, self.root)
+
+    def on_tracker_event(self, event):
+        # Salas em que o usuário entrou ou de que saiu chegam como eventos;
+        # a lista do lobby é atualizada sem consultar o tracker
+        if not self.chat_listbox or not self.chat_listbox.winfo_exists():
+            return
+
+        name = event.get("event")
+        chats = list(getattr(self.chat_listbox, "chats_data", []))
+        if name == "resync":
+            threading.Thread(target=self.refresh_chat_list, daemon=True).start()
+            return
+        if name == "room_member_added" and event["username"] == self.username:
+            if all(chat["id"] != event["room_id"] for chat in chats):
+                chats.append(event["room"])
+        elif name == "room_deleted" or (name == "room_member_removed" and event["username"] == self.username):
+            chats = [chat for chat in chats if chat["id"] != event["room_id"]]
+        else:
+            return
+        self.render_chat_list(chats)
 
     def heartbeat_loop(self):
+        base_dir = os.path.expanduser(f"~/p2p-tr2/{self.username}")
         while True:
             if not self.token: break
-            send_request({"type": "heartbeat", "token": self.token, "port": self.p2p_port})
+            # O digest dos arquivos anunciados vai junto; se o tracker não
+            # tiver os mesmos (removidos por inatividade, por exemplo), manda
+            # a lista completa de uma vez
+            hashes = list_holdings(base_dir)
+            res = send_request({"type": "heartbeat", "token": self.token, "port": self.p2p_port,
+                                "holdings": {"count": len(hashes), "digest": holdings_digest(hashes)}})
+            if res.get("sync_files"):
+                self.sync_holdings(base_dir)
             time.sleep(60)
 
+    def sync_holdings(self, base_dir):
+        res = send_request({"type": "sync_files", "token": self.token, "files": load_holdings(base_dir)})
+        # Arquivos que o tracker tem e que não estavam na lista: guarda os
+        # metadados dos que ainda estão em disco e pede a remoção dos outros
+        remove = []
+        for file in res.get("unlisted", []):
+            chunk_dir = os.path.join(base_dir, file["hash"])
+            if local_chunks.indexes(chunk_dir):
+                save_file_info(chunk_dir, file["filename"], file["size"])
+            else:
+                remove.append(file["hash"])
+        if remove:
+            send_request({"type": "sync_files", "token": self.token, "files": [], "remove": remove})
+
     def setup_main_lobby(self):
         self.clear_frame()
         self.root.title(f"Cliente P2P - {self.username}")
@@ -153,12 +197,13 @@ class P2PClientApp:
             self.opened_windows['file_manager'] = fm_window
 
     def refresh_chat_list(self):
-        if not self.chat_listbox or not self.chat_listbox.winfo_exists():
-            return
-
+        # Pode rodar fora da thread do Tk: a lista só é desenhada via after()
         res = send_request({"type": "list_my_chats", "token": self.token})
-        chats = res.get("chats", [])
+        self.root.after(0, self.render_chat_list, res.get("chats", []))
 
+    def render_chat_list(self, chats):
+        if not self.chat_listbox or not self.chat_listbox.winfo_exists():
+            return
         self.chat_listbox.chats_data = chats
         self.chat_listbox.delete(0, tk.END)
         for chat in chats:
@@ -179,7 +224,6 @@ class P2PClientApp:
             if room_name:
                 res = send_request({"type": "create_chat_room", "token": self.token, "room_name": room_name, "is_private": 0})
                 messagebox.showinfo("Criar Sala", res.get("message"), parent=parent)
-                self.refresh_chat_list()
 
         def create_private():
             dialog.destroy()
@@ -190,16 +234,39 @@ class P2PClientApp:
 
             user_listbox = tk.Listbox(target_window)
             user_listbox.pack(padx=10, pady=5, fill='both', expand=True)
+            user_listbox.users_data = []
 
-            def refresh_users():
-                res = send_request({"type": "list_active_peers", "token": self.token})
-                active_peers = res.get("peers", [])
-                candidates = [u for u in active_peers if u['username'] != self.username]
+            def render_users(candidates):
                 user_listbox.delete(0, tk.END)
                 user_listbox.users_data = candidates
                 for user in candidates:
                     user_listbox.insert(tk.END, f"{user['username']} ({user.get('address', 'Offline')})")
 
+            def fetch_users():
+                res = send_request({"type": "list_active_peers", "token": self.token})
+                active_peers = [u for u in res.get("peers", []) if u['username'] != self.username]
+                target_window.after(0, lambda: target_window.winfo_exists() and render_users(active_peers))
+
+            def refresh_users():
+                threading.Thread(target=fetch_users, daemon=True).start()
+
+            def on_peer_event(event):
+                # Peers que entram e saem atualizam a lista sem nova consulta
+                if event.get("event") == "resync":
+                    refresh_users()
+                elif event.get("topic") == "peers" and event["username"] != self.username:
+                    candidates = [u for u in user_listbox.users_data if u['username'] != event["username"]]
+                    if event["event"] == "peer_online":
+                        candidates.append({"username": event["username"], "address": event["address"]})
+                    render_users(candidates)
+
+            def on_destroy(event):
+                if event.widget is target_window:
+                    unsubscribe_events(on_peer_event)
+
+            subscribe_events(self.token, on_peer_event, target_window)
+            target_window.bind("<Destroy>", on_destroy)
+
             def confirm_private_chat():
                 selected = user_listbox.curselection()
                 if selected:
@@ -207,7 +274,6 @@ class P2PClientApp:
                     room_name = f"Privado com {target_user}"
                     res = send_request({"type": "create_chat_room", "token": self.token, "room_name": room_name, "is_private": 1, "invited_user": target_user})
                     messagebox.showinfo("Criar Sala", res.get("message"), parent=target_window)
-                    self.refresh_chat_list()
                     target_window.destroy()
 
             tk.Button(target_window, text="Atualizar", command=refresh_users).pack(pady=5)
@@ -1,22 +1,79 @@
 import hashlib
-import json
-import socket
+import threading
+import tkinter as tk
+
+from peer.tracker_client import TrackerPool, TrackerSubscription
 
 TRACKER_HOST = "localhost"
 TRACKER_PORT = 5000
+MAX_BATCH_SIZE = 100
+
+_tracker_pool = None
+_tracker_pool_lock = threading.Lock()
+
+_subscription = None
+# listener da janela -> função registrada na assinatura
+_gui_listeners = {}
+
+
+def get_tracker_pool():
+    global _tracker_pool
+    with _tracker_pool_lock:
+        if _tracker_pool is None:
+            _tracker_pool = TrackerPool(TRACKER_HOST, TRACKER_PORT)
+        return _tracker_pool
+
+
+def subscribe_events(token, listener, widget):
+    # Uma única assinatura de eventos por cliente, compartilhada pelas janelas.
+    # Os eventos chegam na thread da assinatura, mas o Tk só pode ser usado na
+    # thread da interface: o listener roda lá, via widget.after().
+    global _subscription
+
+    def on_event(event):
+        try:
+            widget.after(0, listener, event)
+        except (RuntimeError, tk.TclError):
+            # Janela já destruída ou mainloop encerrado
+            pass
+
+    with _tracker_pool_lock:
+        if _subscription is None or _subscription.token != token:
+            if _subscription:
+                _subscription.close()
+            _subscription = TrackerSubscription(TRACKER_HOST, TRACKER_PORT, token)
+        _gui_listeners[listener] = on_event
+        _subscription.add_listener(on_event)
+
+
+def unsubscribe_events(listener):
+    with _tracker_pool_lock:
+        on_event = _gui_listeners.pop(listener, None)
+        if _subscription and on_event:
+            _subscription.remove_listener(on_event)
 
 
 def send_request(payload):
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((TRACKER_HOST, TRACKER_PORT))
-            s.sendall(json.dumps(payload).encode('utf-8'))
-            response_data = s.recv(16384).decode('utf-8')
-            return json.loads(response_data)
+        return get_tracker_pool().request(payload)
     except Exception as e:
         print(f"\n[!] Erro na comunicação com o tracker: {e}")
         return {"status": "error", "message": "Não foi possível conectar ao tracker."}
 
 
+def send_batch(token, requests):
+    # Várias requisições em uma ida e volta ao tracker (por lote de até
+    # MAX_BATCH_SIZE); devolve as respostas na mesma ordem das requisições
+    responses = []
+    for i in range(0, len(requests), MAX_BATCH_SIZE):
+        chunk = requests[i:i + MAX_BATCH_SIZE]
+        res = send_request({"type": "batch", "token": token, "requests": chunk})
+        if res.get("status") == "success":
+            responses.extend(res["responses"])
+        else:
+            responses.extend({"status": "error", "message": res.get("message")} for _ in chunk)
+    return responses
+
+
 def hash_password(password: str):
     return hashlib.sha256(password.encode()).hexdigest()
@@ -1,32 +1,144 @@
+import base64
+import hashlib
 import random
 import socket
-import json
 import threading
+import time
 import os
-from queue import Queue
-from .chunk_manager import reassemble_file, hash_file
+from collections import deque
+from .chunk_manager import local_chunks, reassemble_file, hash_file, decode_bitfield
+from .transport import PEER_BUSY, FrameError, pack_frame, recv_exactly, recv_frame, request, send_frame, tune_socket
 
 
 CHUNK_SIZE = 64 * 1024  # 64KB padrão
-
-
-def connect_and_send(peer, payload):
-    host, port = peer.split(":")
-    port = int(port)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.settimeout(5)
-        s.connect((host, port))
-        s.sendall(json.dumps(payload).encode())
-        data = s.recv(8192).decode()
-        return json.loads(data.strip())
-
-
-def get_chunk_map(peer, file_hash):
+HAVE_BATCH = 16  # chunks novos acumulados antes de avisar o tracker
+# Chunks em voo na mesma conexão; as respostas voltam na ordem dos pedidos,
+# cada uma marcada com o índice do chunk. Os pedidos vão em get_chunks de até
+# PIPELINE_DEPTH chunks, e a janela é reabastecida quando cai à metade.
+PIPELINE_DEPTH = 16
+PEER_TIMEOUT = 10
+# Maior chunk aceito de um peer; o resto é cabeçalho corrompido
+MAX_CHUNK_SIZE = 4 * CHUNK_SIZE
+# Peer que recusa ou falha fica de fora por PEER_BACKOFF segundos, dobrando a
+# cada falha seguida até MAX_PEER_BACKOFF. As falhas contam pela metade a cada
+# FAILURE_HALF_LIFE segundos, para um peer que se recuperou voltar à frente.
+PEER_BACKOFF = 0.2
+MAX_PEER_BACKOFF = 2
+FAILURE_HALF_LIFE = 30
+# Falhas (fora "ocupado") aceitas por chunk antes de desistir do download
+MAX_CHUNK_ATTEMPTS = 8
+
+
+class MultiChunkUnsupported(FrameError):
+    # Peer de versão antiga recusou get_chunks
+    pass
+
+
+class PeerConnection:
+    # Conexão longa com um peer, reaproveitada entre pedidos. Com
+    # multi_chunk=False (peers antigos) os pedidos vão como get_chunk
+    # seguidos, ainda em pipeline.
+    def __init__(self, peer, timeout=PEER_TIMEOUT, multi_chunk=True):
+        host, port = peer.split(":")
+        self.peer = peer
+        self.multi_chunk = multi_chunk
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.sock.settimeout(timeout)
+            tune_socket(self.sock)
+            self.sock.connect((host, int(port)))
+        except OSError:
+            self.sock.close()
+            raise
+
+    def request(self, payload):
+        return request(self.sock, payload)
+
+    def send_chunk_request(self, file_hash, chunk_index):
+        send_frame(self.sock, {"type": "get_chunk", "file_hash": file_hash, "chunk": chunk_index})
+
+    def send_chunks_request(self, file_hash, indexes):
+        # Uma resposta por chunk, na ordem pedida; sequências contíguas vão
+        # como intervalo
+        if not self.multi_chunk:
+            self.sock.sendall(b"".join(
+                pack_frame({"type": "get_chunk", "file_hash": file_hash, "chunk": i}) for i in indexes
+            ))
+            return
+        if indexes == list(range(indexes[0], indexes[0] + len(indexes))):
+            payload = {"type": "get_chunks", "file_hash": file_hash, "start": indexes[0], "end": indexes[-1] + 1}
+        else:
+            payload = {"type": "get_chunks", "file_hash": file_hash, "chunks": indexes}
+        send_frame(self.sock, payload)
+
+    def recv_chunk(self, buffer=None):
+        # (índice, dados, hash); se o peer recusou, dados é None e no lugar
+        # do hash vem a mensagem de erro
+        res, _ = recv_frame(self.sock)
+        if not isinstance(res, dict):
+            raise FrameError(f"Resposta inválida de {self.peer}")
+        if res.get("status") != "success":
+            # Servidores atuais marcam com o índice até os erros de chunk;
+            # um erro sem índice é a recusa do próprio get_chunks
+            if self.multi_chunk and "chunk" not in res:
+                raise MultiChunkUnsupported(res.get("message", "get_chunks recusado"))
+            return res.get("chunk"), None, res.get("message")
+        size, chunk_hash = res.get("size"), res.get("hash")
+        if not isinstance(size, int) or not 0 <= size <= MAX_CHUNK_SIZE or not isinstance(chunk_hash, str):
+            raise FrameError(f"Cabeçalho de chunk inválido de {self.peer}")
+        return res.get("chunk"), recv_exactly(self.sock, size, buffer), chunk_hash
+
+    def close(self):
+        self.sock.close()
+
+
+class PeerConnectionPool:
+    # Conexões ociosas por peer, compartilhadas pelas threads de um download
+    def __init__(self):
+        self._idle = {}
+        self._single_chunk = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, peer):
+        with self._lock:
+            idle = self._idle.get(peer)
+            if idle:
+                return idle.pop()
+            multi_chunk = peer not in self._single_chunk
+        return PeerConnection(peer, multi_chunk=multi_chunk)
+
+    def mark_single_chunk(self, peer):
+        # As próximas conexões com esse peer usam só get_chunk
+        with self._lock:
+            self._single_chunk.add(peer)
+
+    def release(self, conn):
+        with self._lock:
+            self._idle.setdefault(conn.peer, []).append(conn)
+
+    def close(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+def get_chunk_map(peer, file_hash, pool=None):
     try:
-        res = connect_and_send(peer, {
-            "type": "chunk_map",
-            "file_hash": file_hash
-        })
+        conn = pool.acquire(peer) if pool else PeerConnection(peer, timeout=5)
+        try:
+            res = conn.request({
+                "type": "chunk_map",
+                "file_hash": file_hash
+            })
+        except Exception:
+            conn.close()
+            raise
+        if pool:
+            pool.release(conn)
+        else:
+            conn.close()
         if res.get("status") == "success":
             return res.get("chunks", [])
     except Exception as e:
@@ -35,65 +147,46 @@ def get_chunk_map(peer, file_hash):
     return []
 
 
-def download_chunk(peer, file_hash, chunk_index, chunk_dir, verbose=True):
-    try:
-        host, port = peer.split(":")
-        port = int(port)
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(10)
-            s.connect((host, port))
-
-            payload = {
-                "type": "get_chunk",
-                "file_hash": file_hash,
-                "chunk": chunk_index
-            }
-            s.sendall(json.dumps(payload).encode())
-
-            header = b""
-            while not header.endswith(b'\n'):
-                header += s.recv(1)
-            res = json.loads(header.decode().strip())
-
-            if res.get("status") != "success":
-                print(f"[!] Erro recebendo chunk {chunk_index} de {peer}")
-                return False
-
-            size = res.get("size")
-            expected_chunk_hash = res.get("hash")
-            received = 0
-
-            os.makedirs(chunk_dir, exist_ok=True)
-
-            temp_chunk_path = os.path.join(chunk_dir, f"temp_{chunk_index}")
-            with open(temp_chunk_path, 'wb') as f:
-                while received < size:
-                    data = s.recv(min(4096, size - received))
-                    if not data:
-                        break
-                    f.write(data)
-                    received += len(data)
-
-            chunk_hash = hash_file(temp_chunk_path)
-            chunk_name = f"{chunk_index}_{chunk_hash}"
-            chunk_path = os.path.join(chunk_dir, chunk_name)
-
-            os.rename(temp_chunk_path, chunk_path)
-
-            if chunk_hash != expected_chunk_hash:
-                print(f"[!] Chunk inválido (hash incorreto): {chunk_name}")
-                os.remove(chunk_path)
-                return False
-            if verbose:
-                print(f"[✓] Chunk {chunk_index} baixado de {peer} como {chunk_name}")
-            return True
+def save_chunk(chunk_dir, chunk_index, data, expected_chunk_hash, peer, verbose=True):
+    chunk_hash = hashlib.sha256(data).hexdigest()
+    chunk_name = f"{chunk_index}_{chunk_hash}"
 
-    except Exception as e:
-        print(f"[!] Falha no download do chunk {chunk_index} de {peer}: {e}")
+    if chunk_hash != expected_chunk_hash:
+        print(f"[!] Chunk inválido (hash incorreto): {chunk_name}")
         return False
 
+    os.makedirs(chunk_dir, exist_ok=True)
+
+    temp_chunk_path = os.path.join(chunk_dir, f"temp_{chunk_index}")
+    with open(temp_chunk_path, 'wb') as f:
+        f.write(data)
+    chunk_path = os.path.join(chunk_dir, chunk_name)
+    os.replace(temp_chunk_path, chunk_path)
+    local_chunks.add(chunk_dir, chunk_index, chunk_path, len(data), chunk_hash)
+
+    if verbose:
+        print(f"[✓] Chunk {chunk_index} baixado de {peer} como {chunk_name}")
+    return True
 
-def download_file(username, filename, file_hash, size, peers, max_connections, verbose=True):
+
+def chunk_holders_from_tracker(holders, size, exclude_username=None):
+    # Converte a resposta de get_chunk_holders em {endereço: [chunks]}
+    num_chunks = (size + CHUNK_SIZE - 1) // CHUNK_SIZE
+    chunk_holders = {}
+    for holder in holders:
+        if holder["username"] == exclude_username or not holder.get("address"):
+            continue
+        if holder.get("complete"):
+            available = list(range(num_chunks))
+        else:
+            available = decode_bitfield(base64.b64decode(holder["bitfield"]), num_chunks)
+        if available:
+            chunk_holders[holder["address"]] = available
+    return chunk_holders
+
+
+def download_file(username, filename, file_hash, size, peers, max_connections, verbose=True,
+                  chunk_holders=None, on_chunks=None, on_transfer_stats=None):
     chunk_dir = os.path.expanduser(f"~/p2p-tr2/{username}/{file_hash}")
     output_dir = os.path.expanduser(f"~/p2p-tr2/{username}/arquivos_reconstruidos")
     os.makedirs(chunk_dir, exist_ok=True)
@@ -103,44 +196,219 @@ def download_file(username, filename, file_hash, size, peers, max_connections, v
 
     chunk_peer_map = {}
     chunk_rarity = {}
-
-    if verbose:
-        print("[*] Consultando mapa de chunks dos peers...")
-
-    for peer in peers:
-        available = get_chunk_map(peer, file_hash)
-        for c in available:
-            chunk_peer_map.setdefault(c, []).append(peer)
+    # Uma conexão reaproveitada por peer (e thread), do chunk_map ao último chunk
+    pool = PeerConnectionPool()
+
+    # Com os bitfields vindos do tracker (peer -> chunks) não é preciso
+    # consultar o chunk_map de cada peer antes de começar
+    if chunk_holders is not None:
+        peers = list(chunk_holders)
+        for peer, available in chunk_holders.items():
+            for c in available:
+                chunk_peer_map.setdefault(c, []).append(peer)
+    else:
+        if verbose:
+            print("[*] Consultando mapa de chunks dos peers...")
+
+        for peer in peers:
+            available = get_chunk_map(peer, file_hash, pool)
+            for c in available:
+                chunk_peer_map.setdefault(c, []).append(peer)
 
     if not chunk_peer_map:
         print("[!] Nenhum peer possui o arquivo.")
+        pool.close()
         return False
 
     for chunk_index in chunk_peer_map:
         chunk_rarity[chunk_index] = len(chunk_peer_map[chunk_index])
-
-    chunk_queue = Queue()
-    for c in sorted(chunk_rarity, key=lambda x: chunk_rarity[x]):
-        chunk_queue.put(c)
-
-    def worker():
-        while not chunk_queue.empty():
-            chunk = chunk_queue.get()
-            peers_with_chunk = chunk_peer_map.get(chunk, [])
-            if not peers_with_chunk:
-                chunk_queue.task_done()
-                continue
-
-            peer = random.choice(peers_with_chunk)
-
-            success = download_chunk(
-                peer, file_hash, chunk, chunk_dir, verbose
-            )
-
+    chunk_peer_sets = {c: set(holders) for c, holders in chunk_peer_map.items()}
+
+    # Chunks ainda por baixar, dos mais raros para os mais comuns, e quantos
+    # estão com alguma thread (podem voltar para pending se falharem)
+    pending = dict.fromkeys(sorted(chunk_rarity, key=lambda x: chunk_rarity[x]))
+    taken = 0
+    pending_changed = threading.Condition()
+    # Falhas de cada chunk e os chunks dados como perdidos: nenhum peer os
+    # tem de fato ou falharam MAX_CHUNK_ATTEMPTS vezes
+    attempts = dict.fromkeys(chunk_rarity, 0)
+    lost = []
+    # Threads baixando de cada peer, falhas de cada um (com o instante da
+    # última atualização, para decair) e até quando cada peer fica de fora,
+    # para espalhar a carga e evitar quem não responde ou está ocupado
+    busy = dict.fromkeys({p for holders in chunk_peer_map.values() for p in holders}, 0)
+    failures = {p: (0.0, 0.0) for p in busy}
+    backoff_until = dict.fromkeys(busy, 0.0)
+
+    new_chunks = []
+    new_chunks_lock = threading.Lock()
+
+    # Bytes e tempo gastos com cada peer, para o tracker ranquear uploaders
+    transfer_stats = {}
+
+    def report_chunk(chunk, flush=False):
+        if not on_chunks:
+            return
+        with new_chunks_lock:
+            if chunk is not None:
+                new_chunks.append(chunk)
+            if not new_chunks or (len(new_chunks) < HAVE_BATCH and not flush):
+                return
+            batch = new_chunks[:]
+            new_chunks.clear()
+        on_chunks(batch)
+
+    def take_for(peer, n):
+        # Até n chunks pendentes que esse peer tem (chamar com o lock)
+        nonlocal taken
+        chunks = []
+        for c in pending:
+            if peer in chunk_peer_sets[c]:
+                chunks.append(c)
+                if len(chunks) == n:
+                    break
+        for c in chunks:
+            del pending[c]
+        taken += len(chunks)
+        return chunks
+
+    def failure_score(peer, now):
+        score, updated = failures[peer]
+        return score * 0.5 ** ((now - updated) / FAILURE_HALF_LIFE)
+
+    def take_next():
+        # Escolhe, entre os peers fora de espera que ainda têm chunks
+        # pendentes, o que menos falhou e está menos ocupado, e leva os chunks
+        # mais raros dele; None quando não há mais nada a baixar
+        with pending_changed:
+            while True:
+                if lost:
+                    return None
+                if not pending:
+                    if not taken:
+                        return None
+                    pending_changed.wait()
+                    continue
+                now = time.monotonic()
+                ready = [p for p in busy if backoff_until[p] <= now]
+                for peer in sorted(ready, key=lambda p: (failure_score(p, now), busy[p], random.random())):
+                    chunks = take_for(peer, PIPELINE_DEPTH)
+                    if chunks:
+                        busy[peer] += 1
+                        return peer, chunks
+                # Quem tem os chunks restantes está em espera: dorme até o
+                # primeiro voltar ou algum chunk mudar de estado
+                waits = [backoff_until[p] - now for p in busy if backoff_until[p] > now]
+                if not waits and not taken:
+                    return None
+                pending_changed.wait(min(waits) if waits else None)
+
+    def release_peer(peer, failed):
+        with pending_changed:
+            busy[peer] -= 1
+            now = time.monotonic()
+            score = failure_score(peer, now)
+            if failed:
+                score += 1
+                backoff_until[peer] = now + min(MAX_PEER_BACKOFF, PEER_BACKOFF * 2 ** (score - 1))
+            failures[peer] = (score, now)
+            pending_changed.notify_all()
+
+    def finish(chunks, success, peer=None, missing=False, count=True):
+        # Chunks que falharam voltam para pending. missing: o peer disse não
+        # ter o chunk e sai da lista de quem o tem; count=False para falhas
+        # que não são do chunk (peer ocupado, protocolo antigo).
+        nonlocal taken
+        with pending_changed:
+            taken -= len(chunks)
             if not success:
-                chunk_queue.put(chunk)
+                for c in chunks:
+                    holders = chunk_peer_sets[c]
+                    if missing:
+                        holders.discard(peer)
+                    attempts[c] += count
+                    if not holders or attempts[c] >= MAX_CHUNK_ATTEMPTS:
+                        lost.append(c)
+                    else:
+                        pending[c] = None
+            pending_changed.notify_all()
+
+    def fetch_from_peer(peer, chunks, buffer):
+        # Peer sem o chunk ou sem slot de upload livre conta como falha
+        refused = False
+        try:
+            conn = pool.acquire(peer)
+        except Exception as e:
+            print(f"[!] Falha ao conectar em {peer}: {e}")
+            finish(chunks, False)
+            release_peer(peer, True)
+            return
+
+        # Tudo o que está em in_flight volta para pending se a conexão falhar,
+        # seja qual for o erro; senão as outras threads esperariam para sempre
+        in_flight = deque(chunks)
+        failed = True
+        legacy = False
+        try:
+            conn.send_chunks_request(file_hash, chunks)
+
+            mark = time.monotonic()
+            while in_flight:
+                chunk = in_flight[0]
+                index, data, expected_chunk_hash = conn.recv_chunk(buffer)
+                busy = data is None and expected_chunk_hash == PEER_BUSY
+                # Peers antigos não marcam as respostas de get_chunk
+                if index != chunk and (conn.multi_chunk or index is not None):
+                    raise FrameError(f"Resposta do chunk {index}, esperado {chunk}")
+
+                now = time.monotonic()
+                success = data is not None and save_chunk(chunk_dir, chunk, data, expected_chunk_hash, peer, verbose)
+                if data is None:
+                    print(f"[!] Erro recebendo chunk {chunk} de {peer}: {expected_chunk_hash}")
+                    refused = refused or busy
+                if success:
+                    with new_chunks_lock:
+                        stats = transfer_stats.setdefault(peer, [0, 0.0])
+                        stats[0] += len(data)
+                        stats[1] += now - mark
+                mark = now
+                in_flight.popleft()
+                finish([chunk], success, peer, missing=data is None and not busy, count=not busy)
+                if success:
+                    report_chunk(chunk)
+
+                # Reabastece a janela com outros chunks que este peer tem,
+                # a menos que ele já tenha recusado algum
+                if not refused and not lost and len(in_flight) <= PIPELINE_DEPTH // 2:
+                    with pending_changed:
+                        more = take_for(peer, PIPELINE_DEPTH - len(in_flight))
+                    if more:
+                        in_flight.extend(more)
+                        conn.send_chunks_request(file_hash, more)
+            failed = False
+        except MultiChunkUnsupported:
+            # Não conta como falha: os chunks voltam e o peer passa a receber
+            # get_chunk em pipeline
+            pool.mark_single_chunk(peer)
+            refused = False
+            legacy = True
+        except Exception as e:
+            print(f"[!] Falha no download de chunks de {peer}: {e}")
+            refused = True
+        finally:
+            if failed:
+                conn.close()
+                finish(list(in_flight), False, count=not legacy)
+                release_peer(peer, refused)
+            else:
+                pool.release(conn)
+                release_peer(peer, refused)
 
-            chunk_queue.task_done()
+    def worker():
+        buffer = bytearray(CHUNK_SIZE)
+        while (next_batch := take_next()) is not None:
+            peer, chunks = next_batch
+            fetch_from_peer(peer, chunks, buffer)
 
     num_threads = min(max_connections, len(peers))
     print("Threads used:", num_threads)
@@ -150,12 +418,16 @@ def download_file(username, filename, file_hash, size, peers, max_connections, v
         t.start()
         threads.append(t)
 
-    chunk_queue.join()
+    for t in threads:
+        t.join()
+    pool.close()
+    report_chunk(None, flush=True)
+    if on_transfer_stats and transfer_stats:
+        on_transfer_stats(transfer_stats)
 
-    downloaded_chunks = [
-        fname for fname in os.listdir(chunk_dir) if "_" in fname
-    ]
-    if len(downloaded_chunks) != num_chunks:
+    if lost:
+        print(f"[!] Nenhum peer conseguiu enviar os chunks {sorted(lost)[:10]}")
+    if len(local_chunks.indexes(chunk_dir)) != num_chunks:
         print("[!] Download incompleto. Nem todos os chunks foram baixados.")
         return False
 
@@ -1,3 +1,4 @@
+import asyncio
 import socket
 import threading
 import json
@@ -5,114 +6,211 @@ import os
 import time
 
 from peer.chat import store_message
-from .chunk_manager import hash_file, get_chunks_available
+from .chunk_manager import file_chunk_dir, get_chunks_available, local_chunks
+from .transport import PEER_BUSY, FrameError, hello_response, pack_frame, read_frame, tune_socket
 
 message_queues = {}
 
-def handle_client(username: str, conn: socket.socket, addr: tuple, queues: dict):
+# Limite de chunks em um get_chunks (4 MB com chunks de 64 KB)
+MAX_CHUNKS_PER_REQUEST = 64
+
+# Pedidos de chunk (get_chunk ou get_chunks inteiro) servidos ao mesmo tempo.
+# Os demais esperam em fila, por ordem de chegada, até MAX_WAITING_UPLOADS;
+# além disso recebem "ocupado" na hora e tentam outro peer.
+UPLOAD_SLOTS = int(os.environ.get("P2P_UPLOAD_SLOTS", 4))
+MAX_WAITING_UPLOADS = int(os.environ.get("P2P_MAX_WAITING", 32))
+# Bytes pendentes por conexão antes de parar e esperar o cliente ler
+WRITE_BUFFER_LIMIT = 256 * 1024
+# Cliente que não consome um chunk nesse tempo perde a conexão (e o slot)
+SEND_TIMEOUT = 30
+
+
+class UploadSlots:
+    # Só é usado no event loop do servidor, então dispensa lock
+    def __init__(self, slots, max_waiting):
+        self._semaphore = asyncio.Semaphore(slots)
+        self.max_waiting = max_waiting
+        self.waiting = 0
+
+    async def acquire(self):
+        # False se a fila de espera está cheia
+        if self._semaphore.locked():
+            if self.waiting >= self.max_waiting:
+                return False
+            self.waiting += 1
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self.waiting -= 1
+            return True
+        await self._semaphore.acquire()
+        return True
+
+    def release(self):
+        self._semaphore.release()
+
+
+async def handle_client(username: str, queues: dict, slots: UploadSlots,
+                        reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
     base_dir = os.path.expanduser(f"~/p2p-tr2/{username}")
-    
+    addr = writer.get_extra_info("peername")
+    writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_LIMIT)
+
     try:
-        with conn:
-            data = conn.recv(2048).decode('utf-8').strip()
-            if not data:
+        while True:
+            try:
+                request, codec = await read_frame(reader)
+            except (asyncio.IncompleteReadError, FrameError):
                 return
-            request = json.loads(data)
-            print(f"[P2P Server] Recebido de {addr}: {request['type']}")
-
-            req_type = request.get("type")
-            file_hash = request.get("file_hash")
-
-            if req_type == "chunk_map":
-                chunks = get_chunks_available(base_dir, file_hash)
-                if chunks:
-                    response = {
-                        "status": "success",
-                        "chunks": chunks
-                    }
-                else:
-                    response = {
-                        "status": "error",
-                        "message": "Arquivo não encontrado"
-                    }
-                conn.sendall(json.dumps(response).encode())
-
-            elif req_type == "get_chunk":
-                chunk_index = request.get("chunk")
-
-                file_chunk_dir = os.path.join(base_dir, file_hash)
-
-                chunk_file = None
-                for fname in os.listdir(file_chunk_dir):
-                    if fname.startswith(f"{chunk_index}_"):
-                        chunk_file = fname
-
-                if not chunk_file:
-                    conn.sendall(b'{"status": "error", "message": "Chunk nao encontrado"}')
-                    return
-
-                chunk_path = os.path.join(file_chunk_dir, chunk_file)
-                chunk_size = os.path.getsize(chunk_path)
-
-                response = {
-                    "status": "success",
-                    "hash": hash_file(chunk_path),
-                    "size": chunk_size
-                }
-                conn.sendall(json.dumps(response).encode() + b'\n')
-
-                with open(chunk_path, 'rb') as f:
-                    while data := f.read(4096):
-                        conn.sendall(data)
-
-                print(f"[✓] Chunk {chunk_index} de {file_hash} enviado para {addr}")
-
-            elif req_type == "get_chat_history":
-                room_id = request.get("room_id")
-                history_path = os.path.join(base_dir, "chats", f"{room_id}.json")
-                history = []
-                if os.path.exists(history_path):
-                    with open(history_path, 'r', encoding='utf-8') as f:
-                        history = json.load(f)
-                response = {"status": "success", "history": history}
-                conn.sendall(json.dumps(response).encode('utf-8'))
-
-            elif req_type == "broadcast_message":
-                room_id = request.get("room_id")
-                message_data = request.get("message")
-                
-                if room_id in queues:
-                    queues[room_id].put(message_data)
-                store_message(username, room_id, message_data)
-                
-                conn.sendall(json.dumps({"status": "success"}).encode('utf-8'))
-            
-            else:
-                conn.sendall(json.dumps({"status": "error", "message": "Requisicao invalida"}).encode('utf-8'))
+            await handle_request(username, base_dir, writer, addr, queues, slots, request, codec)
 
     except Exception as e:
         print(f"[!] Erro ao lidar com cliente P2P {addr}: {e}")
+    finally:
+        writer.close()
+
+async def send_frame(writer: asyncio.StreamWriter, obj, codec: int):
+    writer.write(pack_frame(obj, codec))
+    await writer.drain()
+
+async def send_chunk(writer: asyncio.StreamWriter, addr: tuple, base_dir: str, file_hash: str, chunk_index, codec: int):
+    chunk_dir = file_chunk_dir(base_dir, file_hash)
+    if chunk_dir and not local_chunks.cached(chunk_dir):
+        # Primeira consulta a esse arquivo: a leitura do diretório sai do loop
+        await asyncio.to_thread(local_chunks.indexes, chunk_dir)
+    chunk = local_chunks.get(chunk_dir, chunk_index) if chunk_dir and isinstance(chunk_index, int) else None
+    if not chunk:
+        await send_frame(writer, {"status": "error", "chunk": chunk_index, "message": "Chunk nao encontrado"}, codec)
+        return
+
+    chunk_path, chunk_size, chunk_hash = chunk
+    try:
+        f = open(chunk_path, 'rb')
+    except FileNotFoundError:
+        # Apagado do disco depois de indexado
+        local_chunks.discard(chunk_dir, chunk_index)
+        await send_frame(writer, {"status": "error", "chunk": chunk_index, "message": "Chunk nao encontrado"}, codec)
+        return
+
+    with f:
+        writer.write(pack_frame({"status": "success", "chunk": chunk_index, "hash": chunk_hash, "size": chunk_size}, codec))
+        # sendfile do event loop: espera o cabeçalho sair, copia pelo kernel
+        # quando possível e só avança no ritmo em que o cliente lê
+        sent = await asyncio.wait_for(
+            asyncio.get_running_loop().sendfile(writer.transport, f, 0, chunk_size), SEND_TIMEOUT
+        )
+    if sent != chunk_size:
+        # Arquivo encolheu depois de indexado: o cliente já recebeu o tamanho
+        # no cabeçalho e não tem como se ressincronizar, então a conexão cai
+        local_chunks.discard(chunk_dir, chunk_index)
+        raise FrameError(f"Chunk {chunk_index} de {file_hash} com {sent} de {chunk_size} bytes")
+
+    print(f"[✓] Chunk {chunk_index} de {file_hash} enviado para {addr}")
+
+async def send_chunks(writer: asyncio.StreamWriter, addr: tuple, slots: UploadSlots, base_dir: str, file_hash: str, indexes, codec: int):
+    if not await slots.acquire():
+        for chunk_index in indexes:
+            writer.write(pack_frame({"status": "error", "chunk": chunk_index, "message": PEER_BUSY}, codec))
+        await writer.drain()
+        return
+    try:
+        for chunk_index in indexes:
+            await send_chunk(writer, addr, base_dir, file_hash, chunk_index, codec)
+    finally:
+        slots.release()
+
+def load_history(history_path: str) -> list:
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+async def handle_request(username: str, base_dir: str, writer: asyncio.StreamWriter, addr: tuple, queues: dict,
+                         slots: UploadSlots, request: dict, codec: int):
+    print(f"[P2P Server] Recebido de {addr}: {request['type']}")
+
+    req_type = request.get("type")
+    file_hash = request.get("file_hash")
+
+    if req_type == "hello":
+        await send_frame(writer, hello_response(request), codec)
+
+    elif req_type == "chunk_map":
+        chunks = await asyncio.to_thread(get_chunks_available, base_dir, file_hash)
+        if chunks:
+            response = {
+                "status": "success",
+                "chunks": chunks
+            }
+        else:
+            response = {
+                "status": "error",
+                "message": "Arquivo não encontrado"
+            }
+        await send_frame(writer, response, codec)
+
+    elif req_type == "get_chunk":
+        # A conexão continua aberta depois da resposta: o cliente pode mandar
+        # vários get_chunk seguidos e lê as respostas na mesma ordem, cada uma
+        # com o índice do chunk
+        await send_chunks(writer, addr, slots, base_dir, file_hash, [request.get("chunk")], codec)
+
+    elif req_type == "get_chunks":
+        # Vários chunks em sequência: para cada um, o mesmo cabeçalho de
+        # get_chunk (índice, tamanho, hash) seguido dos bytes. Aceita uma
+        # lista ("chunks") ou um intervalo ("start" até "end", exclusivo).
+        indexes = request.get("chunks")
+        if indexes is None and isinstance(request.get("start"), int) and isinstance(request.get("end"), int):
+            indexes = range(request["start"], request["end"])
+        if not isinstance(indexes, (list, range)) or not 0 < len(indexes) <= MAX_CHUNKS_PER_REQUEST:
+            await send_frame(writer, {"status": "error", "message": f"Informe de 1 a {MAX_CHUNKS_PER_REQUEST} chunks"}, codec)
+            return
+        await send_chunks(writer, addr, slots, base_dir, file_hash, indexes, codec)
+
+    elif req_type == "get_chat_history":
+        room_id = request.get("room_id")
+        history_path = os.path.join(base_dir, "chats", f"{room_id}.json")
+        history = await asyncio.to_thread(load_history, history_path)
+        await send_frame(writer, {"status": "success", "history": history}, codec)
+
+    elif req_type == "broadcast_message":
+        room_id = request.get("room_id")
+        message_data = request.get("message")
+        
+        if room_id in queues:
+            queues[room_id].put(message_data)
+        await asyncio.to_thread(store_message, username, room_id, message_data)
+        
+        await send_frame(writer, {"status": "success"}, codec)
+    
+    else:
+        await send_frame(writer, {"status": "error", "message": "Requisicao invalida"}, codec)
 
 def start_p2p_server(username: str, queues: dict, host="0.0.0.0", port=0) -> int:
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Conexões aceitas herdam os buffers do socket de escuta
+    tune_socket(server_socket)
     server_socket.bind((host, port))
     real_port = server_socket.getsockname()[1]
     server_socket.listen()
 
+    # Índice dos chunks em disco, montado uma vez; downloads e anúncios o
+    # atualizam conforme gravam chunks novos
+    local_chunks.load(f"~/p2p-tr2/{username}")
+
     print(f"[📡] Servidor P2P ouvindo em {host}:{real_port}")
 
-    def accept_loop():
-        while True:
-            try:
-                conn, addr = server_socket.accept()
-                handler_thread = threading.Thread(target=handle_client, args=(username, conn, addr, queues), daemon=True)
-                handler_thread.start()
-            except Exception as e:
-                print(f"Erro no loop de aceitação do P2P Server: {e}")
-                break
-
-    threading.Thread(target=accept_loop, daemon=True).start()
+    # O servidor roda em um event loop próprio, numa thread separada da GUI
+    async def serve():
+        slots = UploadSlots(UPLOAD_SLOTS, MAX_WAITING_UPLOADS)
+        server = await asyncio.start_server(
+            lambda reader, writer: handle_client(username, queues, slots, reader, writer), sock=server_socket
+        )
+        async with server:
+            await server.serve_forever()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
     return real_port
 
 if __name__ == "__main__":
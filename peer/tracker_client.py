@@ -0,0 +1,220 @@
+import itertools
+import socket
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from .transport import negotiate, recv_frame, send_frame
+
+POOL_SIZE = 4
+CONNECT_TIMEOUT = 5
+REQUEST_TIMEOUT = 30
+RESUBSCRIBE_MAX_DELAY = 30
+
+
+class TrackerConnection:
+    # Conexão longa com o tracker. Cada requisição leva um "id" e a resposta
+    # volta com o mesmo id, então várias threads podem ter requisições em voo
+    # (pipelining) na mesma conexão.
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.codec = negotiate(self.sock)
+        self.sock.settimeout(None)
+
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def submit(self, payload) -> Future:
+        future = Future()
+        with self._lock:
+            if self.closed:
+                raise ConnectionError("Conexão com o tracker encerrada")
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+
+        try:
+            with self._send_lock:
+                send_frame(self.sock, {**payload, "id": request_id}, self.codec)
+        except OSError:
+            self.close()
+            raise
+        return future
+
+    def abandon(self, future):
+        # Quem esperava desistiu (timeout): a resposta, se vier, é descartada
+        with self._lock:
+            for request_id, pending in self._pending.items():
+                if pending is future:
+                    del self._pending[request_id]
+                    break
+
+    def _read_loop(self):
+        try:
+            while True:
+                response, _ = recv_frame(self.sock)
+                with self._lock:
+                    future = self._pending.pop(response.pop("id", None), None)
+                if future:
+                    future.set_result(response)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending, self._pending = self._pending, {}
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+        for future in pending.values():
+            future.set_exception(ConnectionError("Conexão com o tracker encerrada"))
+
+
+class TrackerPool:
+    def __init__(self, host, port, size=POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.size = size
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _get_connection(self):
+        with self._lock:
+            self._connections = [c for c in self._connections if not c.closed]
+            idle = min(self._connections, key=lambda c: c.in_flight, default=None)
+            if idle and (idle.in_flight == 0 or len(self._connections) >= self.size):
+                return idle
+
+            conn = TrackerConnection(self.host, self.port)
+            self._connections.append(conn)
+            return conn
+
+    def request(self, payload, timeout=REQUEST_TIMEOUT):
+        # Só repete quando o envio falhou (conexão velha); se a requisição
+        # chegou a sair, repetir poderia executá-la duas vezes no tracker.
+        for attempt in range(2):
+            conn = self._get_connection()
+            try:
+                future = conn.submit(payload)
+            except (OSError, ConnectionError):
+                if attempt == 1:
+                    raise
+                continue
+            try:
+                return future.result(timeout)
+            except FutureTimeout:
+                conn.abandon(future)
+                raise
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+
+
+class TrackerSubscription:
+    # Conexão dedicada que recebe os eventos do tracker ("subscribe") e os
+    # repassa aos ouvintes. Se a conexão cair, reconecta e entrega um evento
+    # "resync": o que mudou enquanto ela estava fora precisa ser buscado.
+    def __init__(self, host, port, token, topics=None):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.topics = topics
+        self.closed = False
+        self.sock = None
+        self._listeners = []
+        self._lock = threading.Lock()
+
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def add_listener(self, listener):
+        with self._lock:
+            self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self._listeners = [l for l in self._listeners if l is not listener]
+
+    def _dispatch(self, event):
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                print(f"[!] Erro ao tratar evento do tracker {event.get('event')}: {e}")
+
+    def _run(self):
+        delay = 1
+        # Depois de uma queda ou recusa, o que mudou nesse meio tempo precisa
+        # ser buscado de novo
+        needs_resync = False
+        while not self.closed:
+            try:
+                self.sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                codec = negotiate(self.sock)
+                payload = {"type": "subscribe", "token": self.token}
+                if self.topics:
+                    payload["topics"] = list(self.topics)
+                send_frame(self.sock, payload, codec)
+                response, _ = recv_frame(self.sock)
+                if response.get("code") == "invalid_token":
+                    print(f"[!] Assinatura de eventos recusada: {response.get('message')}")
+                    return
+                if response.get("status") != "success":
+                    # Tracker sobrecarregado, limite de requisições...: tenta
+                    # de novo, esperando pelo menos o retry_after
+                    print(f"[!] Assinatura de eventos recusada: {response.get('message')}; tentando de novo")
+                    retry_after = response.get("retry_after")
+                    if isinstance(retry_after, (int, float)):
+                        delay = min(max(delay, retry_after), RESUBSCRIBE_MAX_DELAY)
+                    needs_resync = True
+                else:
+                    self.sock.settimeout(None)
+
+                    if needs_resync:
+                        self._dispatch({"type": "event", "topic": None, "event": "resync"})
+                    needs_resync = True
+                    delay = 1
+
+                    while True:
+                        event, _ = recv_frame(self.sock)
+                        if event.get("type") == "event":
+                            self._dispatch(event)
+            except (OSError, ValueError):
+                pass
+            finally:
+                if self.sock:
+                    self.sock.close()
+
+            if not self.closed:
+                time.sleep(delay)
+                delay = min(delay * 2, RESUBSCRIBE_MAX_DELAY)
+
+    def close(self):
+        self.closed = True
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
@@ -0,0 +1,134 @@
+import json
+import socket
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Cada frame é: tamanho do payload (4 bytes, big-endian) + codec (1 byte) + payload
+HEADER = struct.Struct("!IB")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Buffers do SO para conexões que transferem chunks; o padrão costuma ficar
+# em dezenas de KB e limita a vazão em links com latência maior
+SOCKET_BUFFER_SIZE = 1024 * 1024
+
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+
+CODEC_NAMES = {"json": CODEC_JSON, "msgpack": CODEC_MSGPACK}
+
+# Recusa temporária de chunk (sem slot de upload livre); qualquer outro erro
+# de chunk quer dizer que o peer não o tem
+PEER_BUSY = "Peer ocupado"
+
+
+class FrameError(ConnectionError):
+    pass
+
+
+def supported_codecs() -> list[str]:
+    if msgpack is not None:
+        return ["msgpack", "json"]
+    return ["json"]
+
+
+def choose_codec(offered) -> int:
+    supported = supported_codecs()
+    for name in offered or []:
+        if name in supported:
+            return CODEC_NAMES[name]
+    return CODEC_JSON
+
+
+def codec_name(codec: int) -> str:
+    return "msgpack" if codec == CODEC_MSGPACK else "json"
+
+
+def encode(obj, codec=CODEC_JSON) -> bytes:
+    if codec == CODEC_MSGPACK:
+        if msgpack is None:
+            raise FrameError("Codec msgpack não disponível")
+        return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def decode(payload, codec=CODEC_JSON):
+    if codec == CODEC_MSGPACK:
+        if msgpack is None:
+            raise FrameError("Codec msgpack não disponível")
+        return msgpack.unpackb(payload, raw=False)
+    if codec != CODEC_JSON:
+        raise FrameError(f"Codec desconhecido: {codec}")
+    return json.loads(str(payload, "utf-8"))
+
+
+def pack_frame(obj, codec=CODEC_JSON) -> bytes:
+    payload = encode(obj, codec)
+    return HEADER.pack(len(payload), codec) + payload
+
+
+def recv_exactly(sock, size, buffer=None) -> memoryview:
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+    view = memoryview(buffer)[:size]
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise FrameError("Conexão encerrada pelo outro lado")
+        received += n
+    return view
+
+
+def send_frame(sock, obj, codec=CODEC_JSON):
+    sock.sendall(pack_frame(obj, codec))
+
+
+def tune_socket(sock):
+    # Antes de connect/listen, para valer no handshake (window scaling)
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+        except OSError:
+            pass
+
+
+def recv_frame(sock, buffer=None):
+    size, codec = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame grande demais: {size} bytes")
+    return decode(recv_exactly(sock, size, buffer), codec), codec
+
+
+def request(sock, payload, codec=CODEC_JSON):
+    send_frame(sock, payload, codec)
+    response, _ = recv_frame(sock)
+    return response
+
+
+# Handshake opcional no início de conexões longas: o cliente oferece os codecs
+# que conhece e o servidor responde com o que vai usar.
+def negotiate(sock) -> int:
+    response = request(sock, {"type": "hello", "codecs": supported_codecs()})
+    if response.get("status") != "success":
+        return CODEC_JSON
+    return CODEC_NAMES.get(response.get("codec"), CODEC_JSON)
+
+
+def hello_response(req) -> dict:
+    codec = choose_codec(req.get("codecs"))
+    return {"status": "success", "codec": codec_name(codec)}
+
+
+async def read_frame(reader):
+    size, codec = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame grande demais: {size} bytes")
+    return decode(await reader.readexactly(size), codec), codec
+
+
+def write_frame(writer, obj, codec=CODEC_JSON):
+    writer.write(pack_frame(obj, codec))
@@ -0,0 +1,191 @@
+import asyncio
+import itertools
+import os
+import time
+
+# Classes de prioridade na fila do banco: requisições baratas (heartbeat,
+# anúncios) passam na frente das que varrem o catálogo
+PRIORITY_CHEAP = 0
+PRIORITY_NORMAL = 1
+PRIORITY_EXPENSIVE = 2
+
+CHEAP_TYPES = {"heartbeat", "announce_chunks", "report_transfers"}
+EXPENSIVE_TYPES = {
+    "list_files", "search_files", "get_user_tier", "get_file_peers", "list_active_peers", "batch", "sync_files",
+}
+
+# Token buckets: (requisições por segundo, rajada). Cada sessão (ou usuário
+# ou IP, sem token) tem um bucket geral e um por tipo listado em
+# TYPE_LIMITS; cada IP tem ainda um bucket próprio, para quem troca de token
+# a cada requisição.
+# TRACKER_IP_RATE=0 desliga o limite por IP (vários peers atrás do mesmo
+# endereço, benchmark local).
+SESSION_LIMIT = (50, 100)
+TYPE_LIMITS = {
+    "list_files": (5, 20),
+    "search_files": (5, 10),
+    "get_user_tier": (2, 5),
+    "get_file_peers": (10, 20),
+    "list_active_peers": (2, 5),
+    "sync_files": (0.2, 3),
+    "register": (1, 5),
+    "login": (1, 5),
+    # Não exige token: o limite fica no IP
+    "stats": (1, 5),
+}
+IP_RATE = float(os.environ.get("TRACKER_IP_RATE", 1000))
+IP_LIMIT = (IP_RATE, 2 * IP_RATE)
+
+# Buckets parados há mais que isso (e cheios de novo) são descartados
+BUCKET_IDLE_TIMEOUT = 120
+PRUNE_INTERVAL = 30
+
+# Fila para o pool do banco. Passando do limite a requisição é recusada na
+# hora, sem esperar; as baratas têm uma folga maior.
+MAX_QUEUED_REQUESTS = int(os.environ.get("TRACKER_MAX_QUEUED", 512))
+CHEAP_QUEUE_HEADROOM = 2
+
+
+def request_priority(req_type):
+    if req_type in CHEAP_TYPES:
+        return PRIORITY_CHEAP
+    if req_type in EXPENSIVE_TYPES:
+        return PRIORITY_EXPENSIVE
+    return PRIORITY_NORMAL
+
+
+def request_costs(request):
+    # Custo por tipo: um lote conta como todas as suas sub-requisições, cada
+    # uma no bucket do seu próprio tipo
+    req_type = request.get("type")
+    if req_type == "batch" and isinstance(request.get("requests"), list) and request["requests"]:
+        costs = {}
+        for sub_request in request["requests"]:
+            sub_type = sub_request.get("type") if isinstance(sub_request, dict) else None
+            # Entradas inválidas (recusadas uma a uma no lote) contam sem tipo
+            sub_type = sub_type if isinstance(sub_type, str) else None
+            costs[sub_type] = costs.get(sub_type, 0) + 1
+        return costs
+    return {req_type: 1}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, cost, now):
+        self._refill(now)
+        return self.tokens >= cost
+
+    def take(self, cost):
+        # Pode ficar negativo: um lote maior que a rajada só passa com o
+        # bucket cheio e deixa uma dívida a pagar antes do próximo
+        self.tokens -= cost
+
+    def retry_after(self, cost):
+        return max(0.0, (min(cost, self.burst) - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    # Só é usado no event loop, então dispensa lock
+    def __init__(self):
+        self._buckets = {}
+        self._last_prune = time.monotonic()
+
+    def _bucket(self, key, limit, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(limit[0], limit[1], now)
+        return bucket
+
+    def check(self, request, addr):
+        # Devolve None se a requisição pode seguir, ou quantos segundos o
+        # cliente deve esperar. Só consome dos buckets se todos tiverem saldo.
+        now = time.monotonic()
+        if now - self._last_prune > PRUNE_INTERVAL:
+            self._prune(now)
+
+        # register/login não têm token: o limite fica no par (IP, usuário), para
+        # que ninguém consiga bloquear o login de outro usuário de fora
+        token, username = request.get("token"), request.get("username")
+        if isinstance(token, str) and token:
+            client = token
+        else:
+            client = (addr[0], username if isinstance(username, str) else None)
+        costs = request_costs(request)
+        cost = sum(costs.values())
+
+        charges = [(self._bucket(("session", client), SESSION_LIMIT, now), cost)]
+        for req_type, type_cost in costs.items():
+            if req_type in TYPE_LIMITS:
+                charges.append((self._bucket(("type", client, req_type), TYPE_LIMITS[req_type], now), type_cost))
+        if IP_RATE > 0:
+            charges.append((self._bucket(("ip", addr[0]), IP_LIMIT, now), cost))
+
+        blocked = [(b, c) for b, c in charges if not b.available(min(c, b.burst), now)]
+        if blocked:
+            return max(b.retry_after(c) for b, c in blocked)
+        for bucket, charge in charges:
+            bucket.take(charge)
+        return None
+
+    def _prune(self, now):
+        self._last_prune = now
+        idle = [
+            key for key, bucket in self._buckets.items()
+            if now - bucket.updated > BUCKET_IDLE_TIMEOUT and bucket.available(bucket.burst, now)
+        ]
+        for key in idle:
+            del self._buckets[key]
+
+
+class RequestScheduler:
+    # Fila de prioridade na frente do pool do banco: DB_WORKERS consumidores
+    # tiram sempre a requisição de maior prioridade (FIFO dentro da mesma
+    # classe) e a executam no executor.
+    def __init__(self, executor, workers):
+        self.executor = executor
+        self.workers = workers
+        self._queue = asyncio.PriorityQueue()
+        self._sequence = itertools.count()
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    @property
+    def queued(self):
+        return self._queue.qsize()
+
+    def overloaded(self, priority):
+        limit = MAX_QUEUED_REQUESTS * (CHEAP_QUEUE_HEADROOM if priority == PRIORITY_CHEAP else 1)
+        return self._queue.qsize() >= limit
+
+    def submit(self, priority, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._sequence), future, func, args))
+        return future
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, future, func, args = await self._queue.get()
+            if future.cancelled():
+                continue
+            try:
+                result = await loop.run_in_executor(self.executor, func, *args)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
@@ -1,11 +1,8 @@
-import sqlite3
-from database import init_db, DB_FILE
+from database import get_connection
 
 
 def register_user(username: str, password: str):
-    init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
 
     try:
         cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
@@ -16,18 +13,13 @@ def register_user(username: str, password: str):
             "INSERT INTO users (username, password_hash) VALUES (?, ?)",
             (username, password),
         )
-        conn.commit()
         return True, "Usuário registrado com sucesso."
     except Exception as e:
         return False, f"Erro ao registrar: {e}"
-    finally:
-        conn.close()
 
 
 def login_user(username: str, password_hash: str):
-    init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
 
     try:
         cursor.execute(
@@ -43,5 +35,3 @@ def login_user(username: str, password_hash: str):
             return False, "Senha incorreta."
     except Exception as e:
         return False, f"Erro ao fazer login: {e}"
-    finally:
-        conn.close()
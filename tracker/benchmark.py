@@ -0,0 +1,336 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from peer.gui.utils import hash_password
+from peer.transport import read_frame, write_frame
+
+# Peso de cada tipo de requisição no laço dos peers virtuais. Heartbeats
+# dominam, como num cliente real (um a cada minuto por peer).
+DEFAULT_MIX = {
+    "heartbeat": 40,
+    "list_files": 12,
+    "get_user_tier": 10,
+    "register_file": 8,
+    "login": 4,
+    "list_my_chats": 10,
+    "get_chat_members": 10,
+    "add_chat_member": 4,
+    "create_chat_room": 2,
+}
+
+FILES_PER_PEER = 3
+LIST_PAGE_SIZE = 500
+SETUP_CONCURRENCY = 200
+STARTUP_TIMEOUT = 15
+STATS_ATTEMPTS = 3
+
+
+class VirtualPeer:
+    # Um cliente com sua própria conexão ao tracker, uma requisição por vez
+    def __init__(self, index, bench):
+        self.bench = bench
+        self.username = f"bench_{bench.run_id}_{index}"
+        self.password = hash_password(self.username)
+        self.port = 20000 + index % 40000
+        self.token = None
+        self.room_id = None
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.bench.host, self.bench.port)
+
+    async def call(self, req_type, **fields):
+        payload = {"type": req_type, **fields}
+        if self.token and req_type not in ("register", "login"):
+            payload["token"] = self.token
+
+        start = time.perf_counter()
+        if self.writer is None or self.writer.is_closing():
+            self.bench.record(req_type, 0.0, False)
+            raise ConnectionError("Sem conexão com o tracker")
+        try:
+            write_frame(self.writer, payload)
+            await self.writer.drain()
+            response, _ = await read_frame(self.reader)
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            self.bench.record(req_type, time.perf_counter() - start, False)
+            raise ConnectionError(e)
+        ok = response.get("status") == "success"
+        self.bench.record(req_type, time.perf_counter() - start, ok)
+        return response
+
+    async def register_file(self):
+        file_hash = uuid.uuid4().hex * 2
+        await self.call("register_file", hash=file_hash, filename=f"{file_hash[:12]}.bin",
+                        size=random.randint(1, 64) * 65536)
+
+    async def setup(self):
+        await self.connect()
+        await self.call("register", username=self.username, password=self.password)
+        res = await self.call("login", username=self.username, password=self.password)
+        self.token = res.get("token")
+        await self.call("heartbeat", port=self.port)
+        for _ in range(FILES_PER_PEER):
+            await self.register_file()
+        res = await self.call("create_chat_room", room_name=f"sala de {self.username}")
+        self.room_id = res.get("room_id")
+
+    async def step(self, req_type):
+        match req_type:
+            case "heartbeat":
+                await self.call("heartbeat", port=self.port)
+            case "list_files":
+                await self.call("list_files", limit=LIST_PAGE_SIZE)
+            case "get_user_tier":
+                await self.call("get_user_tier")
+            case "register_file":
+                await self.register_file()
+            case "login":
+                res = await self.call("login", username=self.username, password=self.password)
+                self.token = res.get("token", self.token)
+            case "list_my_chats":
+                await self.call("list_my_chats")
+            case "get_chat_members":
+                await self.call("get_chat_members", room_id=self.room_id)
+            case "add_chat_member":
+                other = random.choice(self.bench.peers)
+                await self.call("add_chat_member", room_id=self.room_id, user_to_add=other.username)
+            case "create_chat_room":
+                await self.call("create_chat_room", room_name=f"sala {uuid.uuid4().hex[:8]}")
+
+    async def run(self, deadline, think_time):
+        types, weights = zip(*self.bench.mix.items())
+        while time.monotonic() < deadline:
+            if think_time:
+                await asyncio.sleep(random.expovariate(1 / think_time))
+            try:
+                if self.token is None:
+                    # O setup falhou (ou o login não voltou token): refaz
+                    await self.setup()
+                else:
+                    await self.step(random.choices(types, weights)[0])
+            except (ConnectionError, OSError):
+                # Reconecta; a falha já foi contada como erro
+                try:
+                    await self.connect()
+                except OSError:
+                    await asyncio.sleep(1)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+class Benchmark:
+    def __init__(self, host, port, num_peers, mix):
+        self.host = host
+        self.port = port
+        self.mix = mix
+        self.run_id = uuid.uuid4().hex[:6]
+        self.peers = [VirtualPeer(i, self) for i in range(num_peers)]
+        self.recording = False
+        self.samples = {}
+        self.setup_failures = 0
+
+    def record(self, req_type, elapsed, ok):
+        if self.recording:
+            self.samples.setdefault(req_type, []).append((elapsed, ok))
+
+    async def setup(self):
+        limit = asyncio.Semaphore(SETUP_CONCURRENCY)
+
+        async def setup_peer(peer):
+            async with limit:
+                try:
+                    await peer.setup()
+                except (ConnectionError, OSError):
+                    self.setup_failures += 1
+
+        await asyncio.gather(*(setup_peer(peer) for peer in self.peers))
+
+    async def run(self, duration, think_time):
+        await self.setup()
+        self.recording = True
+        start = time.monotonic()
+        await asyncio.gather(*(peer.run(start + duration, think_time) for peer in self.peers))
+        elapsed = time.monotonic() - start
+        self.recording = False
+
+        for peer in self.peers:
+            peer.close()
+        return elapsed, await self.fetch_server_stats()
+
+    async def fetch_server_stats(self):
+        # Conexão própria: a de um peer pode ter caído ou nem ter subido. O
+        # stats tem limite por IP, o mesmo dos peers virtuais; se estourou,
+        # espera o retry_after e tenta de novo.
+        client = VirtualPeer(len(self.peers), self)
+        try:
+            await client.connect()
+            for _ in range(STATS_ATTEMPTS):
+                response = await client.call("stats")
+                if response.get("status") == "success":
+                    return response.get("stats")
+                await asyncio.sleep(response.get("retry_after") or 1)
+        except (ConnectionError, OSError) as e:
+            print(f"[!] Não foi possível obter as estatísticas do tracker: {e}", file=sys.stderr)
+        finally:
+            client.close()
+        return None
+
+    def report(self, elapsed):
+        report = {}
+        for req_type, samples in sorted(self.samples.items()):
+            latencies = sorted(s[0] * 1000 for s in samples)
+            errors = sum(1 for s in samples if not s[1])
+            report[req_type] = {
+                "count": len(samples),
+                "throughput": round(len(samples) / elapsed, 2),
+                "p50_ms": round(percentile(latencies, 0.50), 3),
+                "p99_ms": round(percentile(latencies, 0.99), 3),
+                "max_ms": round(latencies[-1], 3),
+                "error_rate": round(errors / len(samples), 4),
+            }
+        return report
+
+
+def percentile(sorted_values, q):
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=project_root, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_tracker(port, workdir):
+    # Tracker novo, com banco vazio em um diretório temporário
+    env = {
+        **os.environ,
+        "TRACKER_PORT": str(port),
+        "TRACKER_LOG_LEVEL": "WARNING",
+        # Todos os peers virtuais saem do mesmo IP
+        "TRACKER_IP_RATE": "0",
+        "TRACKER_METRICS_FILE": os.path.join(workdir, "tracker_metrics.json"),
+    }
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(project_root, "tracker", "server.py")], cwd=workdir, env=env
+    )
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("O tracker encerrou durante a inicialização")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("O tracker não respondeu a tempo")
+
+
+def raise_fd_limit(num_peers):
+    # Uma conexão por peer virtual (e outra do lado do tracker, se local)
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 2 * num_peers + 256
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        req_type, weight = item.split("=")
+        mix[req_type.strip()] = float(weight)
+    unknown = set(mix) - set(DEFAULT_MIX)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Tipos desconhecidos: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gera carga no tracker com peers virtuais e mede latência e vazão.")
+    parser.add_argument("--peers", type=int, default=1000, help="número de peers virtuais")
+    parser.add_argument("--duration", type=float, default=30, help="duração da medição em segundos")
+    parser.add_argument("--think", type=float, default=1.0,
+                        help="intervalo médio (s) entre requisições de um peer; 0 = sem pausa")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="pesos por tipo, ex.: heartbeat=50,list_files=10")
+    parser.add_argument("--tracker", help="host:porta de um tracker já em execução (senão sobe um local)")
+    parser.add_argument("--output", help="arquivo para o relatório JSON (padrão: stdout)")
+    args = parser.parse_args()
+
+    raise_fd_limit(args.peers)
+
+    process = None
+    with tempfile.TemporaryDirectory(prefix="tracker-bench-") as workdir:
+        if args.tracker:
+            host, port = args.tracker.rsplit(":", 1)
+            port = int(port)
+        else:
+            host, port = "127.0.0.1", free_port()
+            process = start_tracker(port, workdir)
+
+        try:
+            bench = Benchmark(host, port, args.peers, args.mix)
+            elapsed, server_stats = asyncio.run(bench.run(args.duration, args.think))
+        finally:
+            if process:
+                process.terminate()
+                process.wait()
+
+    samples = [s for values in bench.samples.values() for s in values]
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.time(),
+        "config": {"peers": args.peers, "duration": args.duration, "think": args.think, "mix": args.mix},
+        "elapsed": round(elapsed, 3),
+        "total": {
+            "count": len(samples),
+            "throughput": round(len(samples) / elapsed, 2),
+            "error_rate": round(sum(1 for s in samples if not s[1]) / len(samples), 4) if samples else 0.0,
+            "setup_failures": bench.setup_failures,
+        },
+        "requests": bench.report(elapsed),
+        "server": server_stats,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
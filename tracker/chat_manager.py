@@ -1,38 +1,55 @@
-import sqlite3
-from database import DB_FILE
+from database import get_connection, transaction
+from events import publish
 from peers import peers_online
 
+def _room_members(cursor, room_id):
+    cursor.execute("SELECT username FROM chat_members WHERE room_id = ?", (room_id,))
+    return {row[0] for row in cursor.fetchall()}
+
+def _publish_member_added(room, username, audience):
+    # Leva os dados da sala para o novo membro incluí-la na sua lista
+    peer_info = peers_online.get(username)
+    publish("chats", "room_member_added", {
+        "room_id": room["id"],
+        "room": room,
+        "username": username,
+        "address": peer_info.peer_address if peer_info else None,
+    }, audience=audience)
+
 def create_chat_room(room_name, owner_username, is_private=0, invited_user=None):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with transaction() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT INTO chat_rooms (room_name, owner_username, is_private) VALUES (?, ?, ?)", (room_name, owner_username, is_private))
             room_id = cursor.lastrowid
             cursor.execute("INSERT INTO chat_members (room_id, username) VALUES (?, ?)", (room_id, owner_username))
             if is_private and invited_user:
                 cursor.execute("INSERT INTO chat_members (room_id, username) VALUES (?, ?)", (room_id, invited_user))
-            conn.commit()
-            return room_id, "Sala criada com sucesso."
+        members = {owner_username, invited_user} if is_private and invited_user else {owner_username}
+        room = {"id": room_id, "name": room_name, "owner": owner_username, "is_private": bool(is_private)}
+        for member in members:
+            _publish_member_added(room, member, members)
+        return room_id, "Sala criada com sucesso."
     except Exception as e:
         return None, f"Erro ao criar sala: {e}"
 
 def get_user_chats(username):
-    with sqlite3.connect(DB_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT cr.id, cr.room_name, cr.owner_username, cr.is_private
-            FROM chat_rooms cr
-            JOIN chat_members cm ON cr.id = cm.room_id
-            WHERE cm.username = ?
-        """, (username,))
-        chats = [{"id": row[0], "name": row[1], "owner": row[2], "is_private": bool(row[3])} for row in cursor.fetchall()]
-        return chats
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT cr.id, cr.room_name, cr.owner_username, cr.is_private
+        FROM chat_rooms cr
+        JOIN chat_members cm ON cr.id = cm.room_id
+        WHERE cm.username = ?
+    """, (username,))
+    chats = [{"id": row[0], "name": row[1], "owner": row[2], "is_private": bool(row[3])} for row in cursor.fetchall()]
+    return chats
 
 def add_member_to_chat(room_id, user_to_add, requester_username):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with transaction() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT owner_username FROM chat_rooms WHERE id = ?", (room_id,))
+            cursor.execute("SELECT owner_username, room_name, is_private FROM chat_rooms WHERE id = ?", (room_id,))
             owner = cursor.fetchone()
             if not owner or owner[0] != requester_username:
                 return False, "Apenas o moderador pode adicionar membros."
@@ -42,14 +59,18 @@ def add_member_to_chat(room_id, user_to_add, requester_username):
                 return False, f"Usuário '{user_to_add}' não encontrado."
 
             cursor.execute("INSERT OR IGNORE INTO chat_members (room_id, username) VALUES (?, ?)", (room_id, user_to_add))
-            conn.commit()
-            return True, f"'{user_to_add}' adicionado à sala."
+            added = cursor.rowcount > 0
+            members = _room_members(cursor, room_id)
+        if added:
+            room = {"id": room_id, "name": owner[1], "owner": owner[0], "is_private": bool(owner[2])}
+            _publish_member_added(room, user_to_add, members)
+        return True, f"'{user_to_add}' adicionado à sala."
     except Exception as e:
         return False, f"Erro ao adicionar membro: {e}"
     
 def remove_member_from_chat(room_id, user_to_remove, requester_username):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with transaction() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT owner_username FROM chat_rooms WHERE id = ?", (room_id,))
             owner = cursor.fetchone()
@@ -59,39 +80,41 @@ def remove_member_from_chat(room_id, user_to_remove, requester_username):
             cursor.execute("DELETE FROM chat_members WHERE room_id = ? AND username = ?", (room_id, user_to_remove))
             if cursor.rowcount == 0:
                 return False, f"Usuário '{user_to_remove}' não encontrado na sala."
-            
-            conn.commit()
-            return True, f"'{user_to_remove}' removido da sala."
+            members = _room_members(cursor, room_id) | {user_to_remove}
+
+        publish("chats", "room_member_removed", {"room_id": room_id, "username": user_to_remove}, audience=members)
+        return True, f"'{user_to_remove}' removido da sala."
     except Exception as e:
         return False, f"Erro ao remover membro: {e}"
 
 def get_chat_members_with_addresses(room_id):
     members = []
-    with sqlite3.connect(DB_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT username FROM chat_members WHERE room_id = ?", (room_id,))
-        rows = cursor.fetchall()
-        for row in rows:
-            username = row[0]
-            peer_info = peers_online.get(username)
-            address = peer_info['peer_address'] if peer_info else None
-            members.append({"username": username, "address": address})
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT username FROM chat_members WHERE room_id = ?", (room_id,))
+    rows = cursor.fetchall()
+    for row in rows:
+        username = row[0]
+        peer_info = peers_online.get(username)
+        address = peer_info.peer_address if peer_info else None
+        members.append({"username": username, "address": address})
     return members
 
 def delete_chat_room(room_id, requester_username):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with transaction() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT owner_username FROM chat_rooms WHERE id = ?", (room_id,))
             owner = cursor.fetchone()
             if not owner or owner[0] != requester_username:
                 return False, "Apenas o moderador pode remover a sala."
 
+            members = _room_members(cursor, room_id)
             cursor.execute("DELETE FROM chat_members WHERE room_id = ?", (room_id,))
             
             cursor.execute("DELETE FROM chat_rooms WHERE id = ?", (room_id,))
-            
-            conn.commit()
-            return True, "Sala removida com sucesso."
+
+        publish("chats", "room_deleted", {"room_id": room_id}, audience=members)
+        return True, "Sala removida com sucesso."
     except Exception as e:
         return False, f"Erro ao remover a sala: {e}"
\ No newline at end of file
@@ -0,0 +1,105 @@
+import base64
+import binascii
+import time
+
+from database import get_connection, transaction
+from peers import peers_online, tier_scores
+from peer.chunk_manager import merge_bitfield
+
+DEFAULT_FILE_PEERS = 10
+MAX_FILE_PEERS = 50
+# 1 TB em chunks de 64 KB; evita bitfields gigantes vindos de um peer
+MAX_NUM_CHUNKS = 1 << 24
+
+
+def announce_chunks(username, file_hash, num_chunks, bitfield=None, have=None):
+    # bitfield (base64) substitui o que o peer tinha anunciado; have (lista de
+    # índices) só acrescenta chunks novos ao bitfield já guardado
+    if num_chunks is not None and not _valid_num_chunks(num_chunks):
+        return False, f"num_chunks deve ser um inteiro entre 1 e {MAX_NUM_CHUNKS}."
+    if have is not None and not (isinstance(have, list) and all(isinstance(i, int) and not isinstance(i, bool) for i in have)):
+        return False, "have deve ser uma lista de índices."
+
+    now = int(time.time())
+    with transaction() as conn:
+        if bitfield is not None:
+            if num_chunks is None:
+                return False, "Informe num_chunks junto com o bitfield."
+            try:
+                data = base64.b64decode(bitfield, validate=True)
+            except (TypeError, ValueError, binascii.Error):
+                return False, "Bitfield inválido."
+            if len(data) != (num_chunks + 7) // 8:
+                return False, "Tamanho do bitfield não bate com num_chunks."
+        else:
+            row = conn.execute(
+                "SELECT bitfield, num_chunks FROM chunk_bitfields WHERE file_hash = ? AND username = ?",
+                (file_hash, username)
+            ).fetchone()
+            current = row[0] if row else b""
+            num_chunks = num_chunks or (row[1] if row else None)
+            if num_chunks is None:
+                return False, "Informe num_chunks no primeiro anúncio do arquivo."
+            if any(not 0 <= i < num_chunks for i in have or []):
+                return False, f"Índices de chunk devem estar entre 0 e {num_chunks - 1}."
+            data = merge_bitfield(current[:(num_chunks + 7) // 8], have or [], num_chunks)
+
+        conn.execute("""
+            INSERT OR REPLACE INTO chunk_bitfields (file_hash, username, num_chunks, bitfield, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (file_hash, username, num_chunks, data, now))
+    return True, "Chunks anunciados."
+
+
+def _valid_num_chunks(num_chunks):
+    return isinstance(num_chunks, int) and not isinstance(num_chunks, bool) and 0 < num_chunks <= MAX_NUM_CHUNKS
+
+
+def get_chunk_holders(file_hash):
+    conn = get_connection()
+    holders = {}
+
+    # O bitfield anunciado vale mais que o registro em file_peers: um peer
+    # pode estar nos dois e ter só parte dos chunks
+    for username, num_chunks, bitfield in conn.execute(
+        "SELECT username, num_chunks, bitfield FROM chunk_bitfields WHERE file_hash = ?", (file_hash,)
+    ):
+        info = peers_online.get(username)
+        if info:
+            holders[username] = {
+                "username": username,
+                "address": info.peer_address,
+                "num_chunks": num_chunks,
+                "bitfield": base64.b64encode(bitfield).decode(),
+            }
+
+    # Quem registrou o arquivo sem anúncio parcial tem todos os chunks
+    for (username,) in conn.execute("SELECT username FROM file_peers WHERE file_hash = ?", (file_hash,)):
+        info = peers_online.get(username)
+        if info and username not in holders:
+            holders[username] = {"username": username, "address": info.peer_address, "complete": True}
+
+    return list(holders.values())
+
+
+def get_file_peers(file_hash, limit=None, exclude_username=None):
+    # Só os peers online que têm o arquivo (inteiro ou em parte), ordenados
+    # por tier (bytes compartilhados + uptime) e pela taxa de upload recente
+    limit = max(1, min(int(limit or DEFAULT_FILE_PEERS), MAX_FILE_PEERS))
+    holders = [h for h in get_chunk_holders(file_hash) if h["username"] != exclude_username]
+    if not holders:
+        return []
+
+    scores = tier_scores([h["username"] for h in holders])
+    rates = {}
+    for holder in holders:
+        record = peers_online.get(holder["username"])
+        rates[holder["username"]] = record.upload_rate if record else 0.0
+    max_rate = max(rates.values())
+
+    for holder in holders:
+        proporcao_taxa = rates[holder["username"]] / max_rate if max_rate > 0 else 0
+        holder["score"] = round(0.6 * scores[holder["username"]] + 0.4 * proporcao_taxa, 4)
+
+    holders.sort(key=lambda h: (h.get("complete", False), h["score"]), reverse=True)
+    return holders[:limit]
@@ -1,31 +1,97 @@
+import os
 import sqlite3
+import threading
+from contextlib import contextmanager
 
 DB_FILE = "tracker.db"
 
+# Número de processos do tracker. Com mais de um, o estado que era só da
+# memória (presença dos peers, eventos) passa a ficar no banco, que é o que
+# todos os processos enxergam.
+WORKERS = int(os.environ.get("TRACKER_WORKERS", 1))
+SHARED_STATE = WORKERS > 1
+
+# Cada thread do tracker mantém sua própria conexão aberta (o pool de threads
+# do servidor é limitado, então o número de conexões também é). As conexões
+# ficam em modo autocommit: leituras e escritas de um único comando não pagam
+# BEGIN/COMMIT, e transaction() abre uma transação explícita quando preciso.
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+def _create_search_index(conn):
+    # Índice trigram (FTS5) sobre o nome dos arquivos. O conteúdo fica em
+    # files_search, com um INTEGER PRIMARY KEY explícito (o VACUUM não o
+    # renumera, ao contrário do rowid implícito de files) ligado ao hash.
+    # Builds do SQLite sem FTS5 seguem sem ele e search_files cai para LIKE.
+    try:
+        conn.execute("SAVEPOINT fts")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS files_search (
+                id INTEGER PRIMARY KEY,
+                hash TEXT NOT NULL UNIQUE,
+                filename TEXT NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+                filename, content='files_search', content_rowid='id', tokenize='trigram'
+            )
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_files_insert_fts AFTER INSERT ON files
+            BEGIN
+                INSERT INTO files_search (hash, filename) VALUES (NEW.hash, NEW.filename);
+                INSERT INTO files_fts (rowid, filename) SELECT id, filename FROM files_search WHERE hash = NEW.hash;
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_files_delete_fts AFTER DELETE ON files
+            BEGIN
+                INSERT INTO files_fts (files_fts, rowid, filename)
+                SELECT 'delete', id, filename FROM files_search WHERE hash = OLD.hash;
+                DELETE FROM files_search WHERE hash = OLD.hash;
+            END
+        """)
+        conn.execute("INSERT OR IGNORE INTO files_search (hash, filename) SELECT hash, filename FROM files")
+        conn.execute("INSERT INTO files_fts (files_fts) VALUES ('rebuild')")
+        conn.execute("RELEASE fts")
+    except sqlite3.OperationalError as e:
+        conn.execute("ROLLBACK TO fts")
+        conn.execute("RELEASE fts")
+        print(f"[!] Índice de busca FTS5 indisponível ({e}); usando LIKE")
+
+
+def _rekey_search_index(conn):
+    # Bancos da migração 4 têm o índice sobre o rowid implícito de files
+    conn.execute("DROP TRIGGER IF EXISTS trg_files_insert_fts")
+    conn.execute("DROP TRIGGER IF EXISTS trg_files_delete_fts")
+    conn.execute("DROP TABLE IF EXISTS files_fts")
+    conn.execute("DROP TABLE IF EXISTS files_search")
+    _create_search_index(conn)
 
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
 
-    # Tabela de usuários
-    cursor.execute("""
+MIGRATIONS = [
+    # 1: esquema inicial
+    [
+        # Tabela de usuários
+        """
         CREATE TABLE IF NOT EXISTS users (
             username TEXT PRIMARY KEY,
             password_hash TEXT NOT NULL
         )
-    """)
-
-    # Tabela de arquivos
-    cursor.execute("""
+        """,
+        # Tabela de arquivos
+        """
         CREATE TABLE IF NOT EXISTS files (
             hash TEXT PRIMARY KEY,
             filename TEXT NOT NULL,
             size INTEGER NOT NULL
         )
-    """)
-
-    # Associação arquivos ↔ peers
-    cursor.execute("""
+        """,
+        # Associação arquivos ↔ peers
+        """
         CREATE TABLE IF NOT EXISTS file_peers (
             file_hash TEXT,
             username TEXT NOT NULL,
@@ -33,19 +99,17 @@ def init_db():
             FOREIGN KEY(username) REFERENCES users(username),
             PRIMARY KEY (file_hash, username)
         )
-    """)
-
-    cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS sessions (
             token TEXT PRIMARY KEY,
             username TEXT NOT NULL,
             last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY(username) REFERENCES users(username)
         )
-    """)
-
-    # Tabela de salas de chat
-    cursor.execute("""
+        """,
+        # Tabela de salas de chat
+        """
         CREATE TABLE IF NOT EXISTS chat_rooms (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             room_name TEXT NOT NULL,
@@ -54,10 +118,9 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY(owner_username) REFERENCES users(username)
         )
-    """)
-
-    # Tabela de associação de membros da sala de chat
-    cursor.execute("""
+        """,
+        # Tabela de associação de membros da sala de chat
+        """
         CREATE TABLE IF NOT EXISTS chat_members (
             room_id INTEGER,
             username TEXT,
@@ -65,7 +128,293 @@ def init_db():
             FOREIGN KEY(username) REFERENCES users(username),
             PRIMARY KEY (room_id, username)
         )
-    """)
+        """,
+    ],
+    # 2: índices secundários
+    [
+        "CREATE INDEX IF NOT EXISTS idx_file_peers_username ON file_peers(username)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_members_username ON chat_members(username)",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_last_seen ON sessions(last_seen)",
+    ],
+    # 3: contador de versões do catálogo (list_files incremental)
+    [
+        "ALTER TABLE files ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_files_version ON files(version)",
+        """
+        CREATE TABLE IF NOT EXISTS catalog_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0,
+            min_delta_version INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "INSERT OR IGNORE INTO catalog_state (id) VALUES (1)",
+        # Arquivos removidos do catálogo, para que clientes apliquem a remoção
+        """
+        CREATE TABLE IF NOT EXISTS file_tombstones (
+            hash TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_file_tombstones_version ON file_tombstones(version)",
+        # Toda mudança em files/file_peers incrementa a versão do catálogo e
+        # marca o arquivo afetado com ela
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_files_insert_version AFTER INSERT ON files
+        BEGIN
+            UPDATE catalog_state SET version = version + 1;
+            UPDATE files SET version = (SELECT version FROM catalog_state) WHERE hash = NEW.hash;
+            DELETE FROM file_tombstones WHERE hash = NEW.hash;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_files_delete_version AFTER DELETE ON files
+        BEGIN
+            UPDATE catalog_state SET version = version + 1;
+            INSERT OR REPLACE INTO file_tombstones (hash, version)
+            SELECT OLD.hash, version FROM catalog_state;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_file_peers_insert_version AFTER INSERT ON file_peers
+        BEGIN
+            UPDATE catalog_state SET version = version + 1;
+            UPDATE files SET version = (SELECT version FROM catalog_state) WHERE hash = NEW.file_hash;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_file_peers_delete_version AFTER DELETE ON file_peers
+        BEGIN
+            UPDATE catalog_state SET version = version + 1;
+            UPDATE files SET version = (SELECT version FROM catalog_state) WHERE hash = OLD.file_hash;
+        END
+        """,
+    ],
+    # 4: índice de busca por nome de arquivo
+    [
+        _create_search_index,
+    ],
+    # 5: total de bytes por usuário mantido incrementalmente (tiers)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS user_bytes (
+            username TEXT PRIMARY KEY,
+            total_bytes INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_user_bytes_total ON user_bytes(total_bytes)",
+        """
+        INSERT OR REPLACE INTO user_bytes (username, total_bytes)
+        SELECT fp.username, SUM(f.size)
+        FROM file_peers fp
+        JOIN files f ON f.hash = fp.file_hash
+        GROUP BY fp.username
+        """,
+        # file_peers pode ser inserido antes de files (populate.py), por isso
+        # os dois lados atualizam o total
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_file_peers_insert_bytes AFTER INSERT ON file_peers
+        BEGIN
+            INSERT OR IGNORE INTO user_bytes (username, total_bytes) VALUES (NEW.username, 0);
+            UPDATE user_bytes
+            SET total_bytes = total_bytes + COALESCE((SELECT size FROM files WHERE hash = NEW.file_hash), 0)
+            WHERE username = NEW.username;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_file_peers_delete_bytes AFTER DELETE ON file_peers
+        BEGIN
+            UPDATE user_bytes
+            SET total_bytes = total_bytes - COALESCE((SELECT size FROM files WHERE hash = OLD.file_hash), 0)
+            WHERE username = OLD.username;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_files_insert_bytes AFTER INSERT ON files
+        BEGIN
+            UPDATE user_bytes SET total_bytes = total_bytes + NEW.size
+            WHERE username IN (SELECT username FROM file_peers WHERE file_hash = NEW.hash);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_files_delete_bytes AFTER DELETE ON files
+        BEGIN
+            UPDATE user_bytes SET total_bytes = total_bytes - OLD.size
+            WHERE username IN (SELECT username FROM file_peers WHERE file_hash = OLD.hash);
+        END
+        """,
+    ],
+    # 6: chunks que cada peer tem de cada arquivo (inclusive parciais)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS chunk_bitfields (
+            file_hash TEXT NOT NULL,
+            username TEXT NOT NULL,
+            num_chunks INTEGER NOT NULL,
+            bitfield BLOB NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (file_hash, username)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_chunk_bitfields_username ON chunk_bitfields(username)",
+    ],
+    # 7: estado compartilhado entre processos (TRACKER_WORKERS > 1)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS presence (
+            username TEXT PRIMARY KEY,
+            peer_address TEXT NOT NULL,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            upload_rate REAL NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_presence_last_seen ON presence(last_seen)",
+        """
+        CREATE TABLE IF NOT EXISTS event_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL,
+            audience TEXT,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_event_log_created_at ON event_log(created_at)",
+    ],
+    # 8: digest dos arquivos registrados por peer, comparado no heartbeat.
+    # É só um cache de file_peers: linha ausente é recalculada sob demanda.
+    [
+        """
+        CREATE TABLE IF NOT EXISTS peer_holdings (
+            username TEXT PRIMARY KEY,
+            file_count INTEGER NOT NULL,
+            digest TEXT NOT NULL
+        )
+        """,
+    ],
+    # 9: índice de busca com chave própria em vez do rowid de files
+    [
+        _rekey_search_index,
+    ],
+    # 10: versão das linhas de presence, para cada processo buscar só o que
+    # mudou. Remoções marcam deleted_version e forçam uma releitura completa.
+    [
+        "ALTER TABLE presence ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_presence_version ON presence(version)",
+        """
+        CREATE TABLE IF NOT EXISTS presence_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0,
+            deleted_version INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "INSERT OR IGNORE INTO presence_state (id) VALUES (1)",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_presence_insert_version AFTER INSERT ON presence
+        BEGIN
+            UPDATE presence_state SET version = version + 1;
+            UPDATE presence SET version = (SELECT version FROM presence_state) WHERE username = NEW.username;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_presence_update_version
+        AFTER UPDATE OF peer_address, last_seen, upload_rate ON presence
+        BEGIN
+            UPDATE presence_state SET version = version + 1;
+            UPDATE presence SET version = (SELECT version FROM presence_state) WHERE username = NEW.username;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_presence_delete_version AFTER DELETE ON presence
+        BEGIN
+            UPDATE presence_state SET version = version + 1, deleted_version = version + 1;
+        END
+        """,
+    ],
+    # 11: tokens assinados revogados antes de expirar (sobrevivem a restarts)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            nonce TEXT PRIMARY KEY,
+            expires INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires ON revoked_tokens(expires)",
+    ],
+]
+
+
+def get_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+        _local.depth = 0
+    return conn
+
+
+def close_connection():
+    # Antes de um fork: a conexão da thread atual não pode ir para o filho
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+@contextmanager
+def transaction(write=True):
+    conn = get_connection()
+    depth = _local.depth
+
+    # Transações aninhadas viram SAVEPOINTs dentro da transação externa
+    if depth == 0:
+        conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+    else:
+        conn.execute(f"SAVEPOINT sp_{depth}")
+    _local.depth = depth + 1
+
+    try:
+        yield conn
+    except BaseException:
+        _local.depth = depth
+        if depth == 0:
+            conn.execute("ROLLBACK")
+        else:
+            conn.execute(f"ROLLBACK TO sp_{depth}")
+            conn.execute(f"RELEASE sp_{depth}")
+        raise
+    else:
+        _local.depth = depth
+        if depth == 0:
+            conn.execute("COMMIT")
+        else:
+            conn.execute(f"RELEASE sp_{depth}")
+
+
+def table_exists(name):
+    return get_connection().execute(
+        "SELECT 1 FROM sqlite_master WHERE name = ?", (name,)
+    ).fetchone() is not None
+
+
+def init_db():
+    global _schema_ready
+    if _schema_ready:
+        return
+
+    with _schema_lock:
+        if _schema_ready:
+            return
+
+        with transaction() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for target in range(version + 1, len(MIGRATIONS) + 1):
+                for statement in MIGRATIONS[target - 1]:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {target}")
 
-    conn.commit()
-    conn.close()
\ No newline at end of file
+        _schema_ready = True
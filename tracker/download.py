@@ -1,10 +1,10 @@
 import sqlite3
 import time
 
-from peer.gui.utils import send_request, hash_password
+from peer.gui.utils import send_batch, send_request, hash_password
 from tracker.files import list_files
 from tracker.peers import calculate_tier
-from peer.p2p_client import download_file
+from peer.p2p_client import chunk_holders_from_tracker, download_file
 
 DB_FILE = "tracker.db"
 
@@ -44,19 +44,21 @@ def testar_downloads_todos_usuarios():
         tier, max_conn = calculate_tier(user)
         token = obter_token(user)
 
-        res = send_request({"type": "list_active_peers", "token": token})
-        active_peers = res.get("peers", [])
+        respostas = send_batch(token, [{"type": "get_file_peers", "hash": file['hash']} for file in arquivos])
+
+        for file, res in zip(arquivos, respostas):
+            file_peers = res.get("peers", [])
 
-        for file in arquivos:
             start = time.time()
             success = download_file(
                 username=user,
                 filename=file['filename'],
                 file_hash=file['hash'],
                 size=file['size'],
-                peers=[peer["address"] for peer in active_peers if peer["username"] != user],
+                peers=[peer["address"] for peer in file_peers if peer["username"] != user],
                 max_connections=max_conn,
-                verbose=False
+                verbose=False,
+                chunk_holders=chunk_holders_from_tracker(file_peers, file['size'], user) or None
             )
             elapsed = time.time() - start
 
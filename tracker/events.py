@@ -0,0 +1,131 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+
+from database import SHARED_STATE, get_connection
+
+# Tópicos que um cliente pode assinar com a requisição "subscribe"
+TOPICS = ("files", "peers", "chats")
+
+# Eventos pendentes por assinante. Quem não consome a tempo perde a fila e
+# recebe um "resync": deve buscar o estado de novo (list_files com
+# since_version, list_active_peers, ...).
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+# Com vários processos os eventos passam pela tabela event_log: quem publica
+# grava, e cada processo lê o que é novo e entrega aos seus assinantes
+EVENT_POLL_INTERVAL = 0.2
+EVENT_LOG_RETENTION = 60
+
+# Avisos entre os processos do próprio tracker (sessão encerrada, ...). Vão
+# pelo event_log como os eventos, mas com tópico "internal:<tipo>", e em vez
+# de chegar aos assinantes chamam o handler registrado para o tipo.
+INTERNAL_PREFIX = "internal:"
+
+
+class Subscription:
+    __slots__ = ("username", "topics", "loop", "queue")
+
+    def __init__(self, username, topics, loop):
+        self.username = username
+        self.topics = frozenset(topics)
+        self.loop = loop
+        self.queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+
+    def _deliver(self, event):
+        # Roda no event loop da conexão
+        if self.queue.full():
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            event = {"type": "event", "topic": None, "event": "resync"}
+        self.queue.put_nowait(event)
+
+
+_subscriptions = set()
+_lock = threading.Lock()
+_handlers = {}
+
+
+def subscribe(username, topics, loop):
+    subscription = Subscription(username, topics, loop)
+    with _lock:
+        _subscriptions.add(subscription)
+    return subscription
+
+
+def unsubscribe(subscription):
+    with _lock:
+        _subscriptions.discard(subscription)
+
+
+def publish(topic, event, data=None, audience=None):
+    # Pode ser chamado de qualquer thread (pool do banco, limpeza de peers).
+    # audience restringe o evento a um conjunto de usuários (salas de chat).
+    message = {"type": "event", "topic": topic, "event": event, **(data or {})}
+    if SHARED_STATE:
+        get_connection().execute(
+            "INSERT INTO event_log (topic, audience, payload, created_at) VALUES (?, ?, ?, ?)",
+            (topic, json.dumps(sorted(audience)) if audience is not None else None, json.dumps(message), time.time())
+        )
+    else:
+        _deliver_local(topic, message, audience)
+
+
+def on_broadcast(kind, handler):
+    _handlers[INTERNAL_PREFIX + kind] = handler
+
+
+def broadcast(kind, data):
+    # Só faz algo no modo multiprocesso: quem chama já aplicou a mudança no
+    # próprio processo, e os outros a aplicam ao ler o event_log
+    if SHARED_STATE:
+        get_connection().execute(
+            "INSERT INTO event_log (topic, audience, payload, created_at) VALUES (?, NULL, ?, ?)",
+            (INTERNAL_PREFIX + kind, json.dumps(data), time.time())
+        )
+
+
+def _deliver_local(topic, message, audience):
+    if not _subscriptions:
+        return
+
+    with _lock:
+        targets = [
+            s for s in _subscriptions
+            if topic in s.topics and (audience is None or s.username in audience)
+        ]
+
+    for subscription in targets:
+        try:
+            subscription.loop.call_soon_threadsafe(subscription._deliver, message)
+        except RuntimeError:
+            # Event loop já encerrado
+            unsubscribe(subscription)
+
+
+def event_log_loop(prune=False):
+    # Só roda no modo multiprocesso; prune fica com um único processo
+    conn = get_connection()
+    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM event_log").fetchone()[0]
+    last_prune = time.monotonic()
+    while True:
+        time.sleep(EVENT_POLL_INTERVAL)
+        try:
+            for event_id, topic, audience, payload in conn.execute(
+                "SELECT id, topic, audience, payload FROM event_log WHERE id > ? ORDER BY id", (last_id,)
+            ).fetchall():
+                last_id = event_id
+                if topic.startswith(INTERNAL_PREFIX):
+                    handler = _handlers.get(topic)
+                    if handler:
+                        handler(json.loads(payload))
+                    continue
+                _deliver_local(topic, json.loads(payload), set(json.loads(audience)) if audience is not None else None)
+
+            if prune and time.monotonic() - last_prune > EVENT_LOG_RETENTION:
+                conn.execute("DELETE FROM event_log WHERE created_at < ?", (time.time() - EVENT_LOG_RETENTION,))
+                last_prune = time.monotonic()
+        except sqlite3.Error as e:
+            print(f"[!] Erro ao ler eventos compartilhados: {e}")
@@ -1,47 +1,222 @@
-import sqlite3
-from database import DB_FILE, init_db
-from peers import peers_online
+from database import get_connection, transaction, table_exists
+from events import publish
+from peers import peers_online, remove_orphaned_files
+from peer.chunk_manager import holdings_digest
+
+FILE_FIELDS = ("filename", "size", "hash", "peers_info")
+MAX_PAGE_SIZE = 1000
+
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+# O tokenizer trigram só indexa termos com pelo menos 3 caracteres
+SEARCH_MIN_TERM = 3
+
+_search_index = None
+
+def _insert_file(conn, file_hash, filename, size, username):
+    # Devolve os dados do evento file_registered, a publicar só depois do
+    # commit, ou None se o peer já tinha o arquivo
+    conn.execute("INSERT OR IGNORE INTO files (hash, filename, size) VALUES (?, ?, ?)", (file_hash, filename, size))
+    added = conn.execute("INSERT OR IGNORE INTO file_peers (file_hash, username) VALUES (?, ?)", (file_hash, username)).rowcount
+    if not added:
+        return None
+    # O arquivo pode já existir com outro nome; o evento leva o do catálogo
+    filename, size = conn.execute("SELECT filename, size FROM files WHERE hash = ?", (file_hash,)).fetchone()
+    row = conn.execute("SELECT file_count, digest FROM peer_holdings WHERE username = ?", (username,)).fetchone()
+    if row:
+        conn.execute(
+            "UPDATE peer_holdings SET file_count = ?, digest = ? WHERE username = ?",
+            (row[0] + 1, holdings_digest([file_hash], row[1]), username)
+        )
+    return {"hash": file_hash, "filename": filename, "size": size, "username": username}
 
 def register_file(file_hash: str, filename: str, size: int, username: str):
-    init_db()
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR IGNORE INTO files (hash, filename, size) VALUES (?, ?, ?)", (file_hash, filename, size))
-    cursor.execute("INSERT OR IGNORE INTO file_peers (file_hash, username) VALUES (?, ?)", (file_hash, username))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        event = _insert_file(conn, file_hash, filename, size, username)
+    if event:
+        publish("files", "file_registered", event)
 
-def list_files():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-           SELECT f.filename, f.size, f.hash, group_concat(fp.username)
-           FROM files f
-                    LEFT JOIN file_peers fp ON f.hash = fp.file_hash
-           GROUP BY f.hash
-           """
+def _store_holdings(conn, username):
+    # Recalcula o digest a partir de file_peers, que é a fonte de verdade
+    hashes = [row[0] for row in conn.execute("SELECT file_hash FROM file_peers WHERE username = ?", (username,))]
+    holdings = (len(hashes), holdings_digest(hashes))
+    conn.execute(
+        "INSERT OR REPLACE INTO peer_holdings (username, file_count, digest) VALUES (?, ?, ?)",
+        (username, *holdings)
     )
-    results = cursor.fetchall()
-    conn.close()
+    return holdings
 
-    files = []
-    for filename, size, hash_, peers_str in results:
-        peer_usernames = peers_str.split(',') if peers_str else []
-        
-        peers_info = []
-        for name in peer_usernames:
-            peer_details = peers_online.get(name)
-            address = peer_details['peer_address'] if peer_details else None
-            peers_info.append({
-                "username": name,
-                "address": address
-            })
-
-        files.append({
-            "filename": filename,
-            "size": size,
-            "hash": hash_,
-            "peers_info": peers_info,
+def check_holdings(username, file_count, digest):
+    # Heartbeat com digest: True se o tracker tem exatamente os arquivos que o
+    # peer diz ter. Caso contrário o peer deve mandar a lista com sync_files.
+    row = get_connection().execute(
+        "SELECT file_count, digest FROM peer_holdings WHERE username = ?", (username,)
+    ).fetchone()
+    if row == (file_count, digest):
+        return True
+    # Cache ausente ou desatualizado (populate.py escreve direto em file_peers)
+    with transaction() as conn:
+        return _store_holdings(conn, username) == (file_count, digest)
+
+def sync_files(username, files, remove=()):
+    # Registra o que falta da lista do peer. Só sai do catálogo o que ele pede
+    # em remove: o que o tracker tem e o peer não listou volta em "unlisted"
+    # (com nome e tamanho), e o peer guarda os metadados dos que ainda tem ou
+    # pede a remoção dos outros numa segunda chamada. Assim um peer sem
+    # metadados locais (populate.py, arquivos anunciados por versões antigas)
+    # nunca apaga o que o tracker sabe dele.
+    wanted = {f["hash"]: f for f in files}
+    remove = sorted(set(remove) - wanted.keys())
+    events = []
+    with transaction() as conn:
+        current = {row[0] for row in conn.execute("SELECT file_hash FROM file_peers WHERE username = ?", (username,))}
+        stale = [h for h in remove if h in current]
+        for i in range(0, len(stale), MAX_PAGE_SIZE):
+            hashes = stale[i:i + MAX_PAGE_SIZE]
+            conn.execute(
+                f"DELETE FROM file_peers WHERE username = ? AND file_hash IN ({','.join('?' * len(hashes))})",
+                (username, *hashes)
+            )
+        removed = remove_orphaned_files(conn, stale)
+
+        added = wanted.keys() - current
+        for file_hash in added:
+            event = _insert_file(conn, file_hash, wanted[file_hash]["filename"], wanted[file_hash]["size"], username)
+            if event:
+                events.append(event)
+
+        unlisted = []
+        missing = sorted(current - wanted.keys() - set(stale))
+        for i in range(0, len(missing), MAX_PAGE_SIZE):
+            hashes = missing[i:i + MAX_PAGE_SIZE]
+            unlisted.extend(
+                {"hash": file_hash, "filename": filename, "size": size}
+                for file_hash, filename, size in conn.execute(
+                    f"SELECT hash, filename, size FROM files WHERE hash IN ({','.join('?' * len(hashes))})", hashes
+                )
+            )
+        file_count, digest = _store_holdings(conn, username)
+
+    for event in events:
+        publish("files", "file_registered", event)
+    for file_hash in removed:
+        publish("files", "file_removed", {"hash": file_hash})
+    return {
+        "added": len(added), "removed": len(stale), "unlisted": unlisted,
+        "file_count": file_count, "digest": digest,
+    }
+
+def _peers_info(peers_str):
+    peer_usernames = peers_str.split(',') if peers_str else []
+
+    peers_info = []
+    for name in peer_usernames:
+        peer_details = peers_online.get(name)
+        address = peer_details.peer_address if peer_details else None
+        peers_info.append({
+            "username": name,
+            "address": address
         })
-    return files
\ No newline at end of file
+    return peers_info
+
+def list_files_page(cursor=None, limit=None, since_version=None, fields=None):
+    conn = get_connection()
+
+    # A versão é lida antes das linhas: o que mudar durante a consulta volta
+    # de novo no próximo delta, nunca se perde.
+    version, min_delta_version = conn.execute(
+        "SELECT version, min_delta_version FROM catalog_state"
+    ).fetchone()
+
+    # Clientes muito atrasados (tombstones já descartados) recebem tudo de novo
+    reset = since_version is not None and since_version < min_delta_version
+    if reset:
+        since_version = None
+
+    fields = [f for f in (fields or FILE_FIELDS) if f in FILE_FIELDS]
+    with_peers = "peers_info" in fields
+
+    query = "SELECT f.filename, f.size, f.hash"
+    if with_peers:
+        query += ", (SELECT group_concat(fp.username) FROM file_peers fp WHERE fp.file_hash = f.hash)"
+    query += " FROM files f WHERE 1 = 1"
+    params = []
+    if since_version is not None:
+        query += " AND f.version > ?"
+        params.append(since_version)
+    if cursor:
+        query += " AND f.hash > ?"
+        params.append(cursor)
+    query += " ORDER BY f.hash"
+    if limit is not None:
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        query += " LIMIT ?"
+        params.append(limit)
+
+    results = conn.execute(query, params).fetchall()
+
+    files = []
+    for row in results:
+        file = {"filename": row[0], "size": row[1], "hash": row[2]}
+        if with_peers:
+            file["peers_info"] = _peers_info(row[3])
+        files.append({k: v for k, v in file.items() if k in fields or k == "hash"})
+
+    removed = []
+    if since_version is not None and not cursor:
+        removed = [row[0] for row in conn.execute(
+            "SELECT hash FROM file_tombstones WHERE version > ?", (since_version,)
+        )]
+
+    next_cursor = None
+    if limit is not None and len(results) == limit:
+        next_cursor = results[-1][2]
+
+    return {
+        "files": files,
+        "removed": removed,
+        "next_cursor": next_cursor,
+        "version": version,
+        "reset": reset,
+    }
+
+def list_files():
+    return list_files_page()["files"]
+
+def search_files(query, limit=None):
+    global _search_index
+    if _search_index is None:
+        _search_index = table_exists("files_fts")
+
+    limit = max(1, min(int(limit or SEARCH_DEFAULT_LIMIT), SEARCH_MAX_LIMIT))
+    terms = query.split()
+    if not terms:
+        return []
+
+    indexed = [t for t in terms if len(t) >= SEARCH_MIN_TERM] if _search_index else []
+    short = [t for t in terms if t not in indexed]
+
+    peers_subquery = "(SELECT group_concat(fp.username) FROM file_peers fp WHERE fp.file_hash = f.hash)"
+    like_filter = "".join(" AND f.filename LIKE ?" for _ in short)
+    like_params = [f"%{t}%" for t in short]
+
+    if indexed:
+        match = " ".join('"' + t.replace('"', '""') + '"' for t in indexed)
+        sql = (
+            f"SELECT f.filename, f.size, f.hash, {peers_subquery} FROM files_fts "
+            "JOIN files_search s ON s.id = files_fts.rowid "
+            "JOIN files f ON f.hash = s.hash "
+            f"WHERE files_fts MATCH ?{like_filter} ORDER BY files_fts.rank LIMIT ?"
+        )
+        params = [match, *like_params, limit]
+    else:
+        sql = (
+            f"SELECT f.filename, f.size, f.hash, {peers_subquery} FROM files f "
+            f"WHERE 1 = 1{like_filter} ORDER BY length(f.filename) LIMIT ?"
+        )
+        params = [*like_params, limit]
+
+    return [
+        {"filename": filename, "size": size, "hash": hash_, "peers_info": _peers_info(peers_str)}
+        for filename, size, hash_, peers_str in get_connection().execute(sql, params)
+    ]
@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+
+# Limites superiores (ms) dos buckets dos histogramas de latência
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf"))
+
+METRICS_FILE = os.environ.get("TRACKER_METRICS_FILE", "tracker_metrics.json")
+METRICS_DUMP_INTERVAL = int(os.environ.get("TRACKER_METRICS_INTERVAL", 60))
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS_MS)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, ms):
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        self.total += ms
+        self.count += 1
+        if ms > self.max:
+            self.max = ms
+
+    def quantile(self, q):
+        # Estimativa pelo limite superior do bucket onde cai o quantil
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS_MS, self.counts):
+            seen += n
+            if seen >= target:
+                return round(min(bound, self.max), 3)
+        return round(self.max, 3)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50_ms": self.quantile(0.5),
+            "p90_ms": self.quantile(0.9),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": round(self.max, 3),
+            "buckets": {
+                ("+inf" if bound == float("inf") else str(bound)): n
+                for bound, n in zip(LATENCY_BUCKETS_MS, self.counts) if n
+            },
+        }
+
+
+class RequestStats:
+    __slots__ = ("count", "errors", "bytes_out", "latency", "db", "serialize")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes_out = 0
+        self.latency = Histogram()
+        self.db = Histogram()
+        self.serialize = Histogram()
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes_out": self.bytes_out,
+            "latency": self.latency.snapshot(),
+            "db": self.db.snapshot(),
+            "serialize": self.serialize.snapshot(),
+        }
+
+
+class Metrics:
+    # Contadores e histogramas por tipo de requisição. latency vai da
+    # leitura do frame até a resposta escrita; db é o tempo dentro de
+    # process_request (inclui espera por locks do SQLite); serialize é a
+    # codificação da resposta.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.connections = 0
+        self.rejected = {}
+        self.started_at = time.time()
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+            if self.in_flight > self.max_in_flight:
+                self.max_in_flight = self.in_flight
+
+    def request_finished(self, req_type, error, latency, db, serialize, num_bytes):
+        with self._lock:
+            self.in_flight -= 1
+            stats = self._types.get(req_type)
+            if stats is None:
+                stats = self._types[req_type] = RequestStats()
+            stats.count += 1
+            stats.errors += error
+            stats.bytes_out += num_bytes
+            stats.latency.observe(latency * 1000)
+            stats.db.observe(db * 1000)
+            stats.serialize.observe(serialize * 1000)
+
+    def request_rejected(self, reason):
+        with self._lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.connections -= 1
+
+    def snapshot(self):
+        with self._lock:
+            types = {name: stats.snapshot() for name, stats in self._types.items()}
+            return {
+                "timestamp": time.time(),
+                "uptime": round(time.time() - self.started_at, 1),
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "connections": self.connections,
+                "requests": sum(t["count"] for t in types.values()),
+                "errors": sum(t["errors"] for t in types.values()),
+                "rejected": dict(self.rejected),
+                "types": types,
+            }
+
+
+metrics = Metrics()
+
+
+def dump_metrics(path=METRICS_FILE):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(metrics.snapshot(), f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def metrics_dump_loop(path=METRICS_FILE):
+    while True:
+        time.sleep(METRICS_DUMP_INTERVAL)
+        try:
+            dump_metrics(path)
+        except OSError as e:
+            print(f"[!] Erro ao gravar métricas em {path}: {e}")
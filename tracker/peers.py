@@ -1,90 +1,512 @@
-import sqlite3
+import heapq
+import json
+import os
+import threading
 import time
 
-from database import DB_FILE
-
-peers_online = {}
+from database import SHARED_STATE, get_connection, transaction
+from events import publish
 
 HEARTBEAT_TIMEOUT = 300
 CLEANUP_INTERVAL = 60
+MAX_TOMBSTONES = 10000
+# Tombstones vêm também de sync_files, não só de peers
+# expirados: a poda roda no seu próprio ritmo
+TOMBSTONE_PRUNE_INTERVAL = 600
+# Limite de parâmetros por comando SQL nos lotes de limpeza
+SQL_BATCH_SIZE = 500
+# Peso das medições novas na média móvel da taxa de upload de cada peer
+UPLOAD_RATE_ALPHA = 0.3
+# Limites de um relatório de transferência (evita taxas absurdas)
+MAX_REPORTED_BYTES = 1 << 36
+MAX_REPORTED_SECONDS = 24 * 3600
+MAX_UPLOAD_RATE = 1 << 30
+# Idade máxima da cópia local da tabela presence (modo multiprocesso)
+PRESENCE_REFRESH = 1.0
+
+# Reinício a quente: a presença é salva periodicamente e recarregada na
+# subida. Peers ainda válidos ganham RESTART_GRACE segundos para mandar o
+# próximo heartbeat antes de expirar. No modo multiprocesso a própria tabela
+# presence já é o snapshot.
+PRESENCE_FILE = os.environ.get("TRACKER_PRESENCE_FILE", "presence.json")
+PRESENCE_SNAPSHOT_INTERVAL = 30
+RESTART_GRACE = 90
+
+
+class PeerPresence:
+    __slots__ = ("username", "peer_address", "first_seen", "last_seen", "upload_rate")
+
+    def __init__(self, username, peer_address, now):
+        self.username = username
+        self.peer_address = peer_address
+        self.first_seen = now
+        self.last_seen = now
+        self.upload_rate = 0.0
+
+
+class PresenceRegistry:
+    # Peers online indexados por nome, mais dois heaps com remoção preguiçosa:
+    # (last_seen, username) para achar os expirados sem varrer todos, e
+    # (first_seen, username) para achar o maior uptime.
+    def __init__(self):
+        self._peers = {}
+        self._expiry_heap = []
+        self._first_seen_heap = []
+        self._lock = threading.Lock()
+        self._active_cache = None
+
+    def __len__(self):
+        return len(self._peers)
+
+    def __contains__(self, username):
+        return username in self._peers
+
+    def get(self, username):
+        return self._peers.get(username)
+
+    def touch(self, username, peer_address, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            record = self._peers.get(username)
+            if record is None:
+                record = PeerPresence(username, peer_address, now)
+                self._peers[username] = record
+                heapq.heappush(self._first_seen_heap, (now, username))
+                self._compact_first_seen()
+                self._active_cache = None
+            else:
+                if record.peer_address != peer_address:
+                    record.peer_address = peer_address
+                    self._active_cache = None
+                record.last_seen = now
+
+            heapq.heappush(self._expiry_heap, (now, username))
+            # Cada heartbeat deixa uma entrada velha para trás; reconstrói o
+            # heap quando as entradas mortas passam das vivas
+            if len(self._expiry_heap) > 2 * len(self._peers) + 64:
+                self._expiry_heap = [(r.last_seen, r.username) for r in self._peers.values()]
+                heapq.heapify(self._expiry_heap)
+        return record
+
+    def expired(self, cutoff):
+        # Só consulta: devolve pares (username, last_seen) e os peers saem do
+        # registro em discard(), depois que a limpeza no banco for confirmada
+        expired = []
+        with self._lock:
+            while self._expiry_heap and self._expiry_heap[0][0] < cutoff:
+                last_seen, username = heapq.heappop(self._expiry_heap)
+                record = self._peers.get(username)
+                if record is not None and record.last_seen == last_seen:
+                    expired.append((username, last_seen))
+            for username, last_seen in expired:
+                heapq.heappush(self._expiry_heap, (last_seen, username))
+        return expired
+
+    def discard(self, expired):
+        # Ignora quem mandou heartbeat depois de expired()
+        removed = []
+        with self._lock:
+            for username, last_seen in expired:
+                record = self._peers.get(username)
+                if record is not None and record.last_seen == last_seen:
+                    del self._peers[username]
+                    removed.append(username)
+            if removed:
+                self._compact_first_seen()
+                self._active_cache = None
+        return removed
+
+    def _compact_first_seen(self):
+        # Peers que saem deixam a entrada no heap de first_seen até chegarem
+        # ao topo; reconstrói quando as mortas passam da metade (com o lock)
+        if len(self._first_seen_heap) > 2 * len(self._peers) + 64:
+            self._first_seen_heap = [(r.first_seen, r.username) for r in self._peers.values()]
+            heapq.heapify(self._first_seen_heap)
+
+    def oldest_first_seen(self):
+        with self._lock:
+            while self._first_seen_heap:
+                first_seen, username = self._first_seen_heap[0]
+                record = self._peers.get(username)
+                if record is not None and record.first_seen == first_seen:
+                    return first_seen
+                heapq.heappop(self._first_seen_heap)
+        return None
+
+    def _oldest_last_seen(self):
+        while self._expiry_heap:
+            last_seen, username = self._expiry_heap[0]
+            record = self._peers.get(username)
+            if record is not None and record.last_seen == last_seen:
+                return last_seen
+            heapq.heappop(self._expiry_heap)
+        return None
+
+    def active(self, timeout, now=None):
+        # A lista só é refeita quando alguém entra, sai, muda de endereço ou
+        # o peer mais antigo passa do timeout
+        now = time.time() if now is None else now
+        with self._lock:
+            cache = self._active_cache
+            if cache is not None and now < cache[0]:
+                return cache[1]
+
+            peers = [
+                {"username": r.username, "address": r.peer_address}
+                for r in self._peers.values()
+                if now - r.last_seen < timeout
+            ]
+            oldest = self._oldest_last_seen()
+            valid_until = oldest + timeout if oldest is not None else float("inf")
+            self._active_cache = (valid_until, peers)
+            return peers
+
+    def set_upload_rate(self, username, rate):
+        record = self._peers.get(username)
+        if record is not None:
+            record.upload_rate = rate
+
+    def export(self):
+        with self._lock:
+            return [
+                [r.username, r.peer_address, r.first_seen, r.last_seen, r.upload_rate]
+                for r in self._peers.values()
+            ]
+
+    def load(self, entries):
+        with self._lock:
+            for username, peer_address, first_seen, last_seen, upload_rate in entries:
+                record = PeerPresence(username, peer_address, first_seen)
+                record.last_seen = last_seen
+                record.upload_rate = upload_rate
+                self._peers[username] = record
+            self._expiry_heap = [(r.last_seen, r.username) for r in self._peers.values()]
+            self._first_seen_heap = [(r.first_seen, r.username) for r in self._peers.values()]
+            heapq.heapify(self._expiry_heap)
+            heapq.heapify(self._first_seen_heap)
+            self._active_cache = None
+
+    def extend_grace(self, cutoff, min_last_seen):
+        # Quem não tinha expirado até cutoff passa a valer até min_last_seen
+        with self._lock:
+            for record in self._peers.values():
+                if cutoff <= record.last_seen < min_last_seen:
+                    record.last_seen = min_last_seen
+                    heapq.heappush(self._expiry_heap, (min_last_seen, record.username))
+            self._active_cache = None
+
+
+class SharedPresenceRegistry:
+    # Mesma interface de PresenceRegistry, com os dados na tabela presence
+    # para que todos os processos do tracker vejam os mesmos peers. Escritas
+    # vão direto ao banco; leituras usam uma cópia local da tabela, atualizada
+    # quando tem mais de PRESENCE_REFRESH segundos com as linhas cuja versão
+    # passou da última lida. Só depois de uma remoção a tabela é relida toda.
+    def __init__(self, refresh=PRESENCE_REFRESH):
+        self.refresh = refresh
+        self._peers = {}
+        self._oldest_first_seen = None
+        self._version = None
+        self._loaded_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def _snapshot(self):
+        now = time.monotonic()
+        if now - self._loaded_at < self.refresh:
+            return self._peers
+
+        # Leitura consistente: versão e linhas do mesmo instante do banco
+        with transaction(write=False) as conn:
+            version, deleted_version = conn.execute(
+                "SELECT version, deleted_version FROM presence_state"
+            ).fetchone()
+            full = self._version is None or deleted_version > self._version
+            if full:
+                rows = conn.execute(
+                    "SELECT username, peer_address, first_seen, last_seen, upload_rate FROM presence"
+                ).fetchall()
+            elif version > self._version:
+                rows = conn.execute(
+                    "SELECT username, peer_address, first_seen, last_seen, upload_rate FROM presence WHERE version > ?",
+                    (self._version,)
+                ).fetchall()
+            else:
+                rows = []
+
+        with self._lock:
+            # Copia antes de alterar: quem já pegou self._peers pode estar
+            # iterando sobre ele
+            peers = {} if full else dict(self._peers) if rows else self._peers
+            for username, peer_address, first_seen, last_seen, upload_rate in rows:
+                record = PeerPresence(username, peer_address, first_seen)
+                record.last_seen = last_seen
+                record.upload_rate = upload_rate
+                peers[username] = record
+            if full:
+                self._oldest_first_seen = min((r.first_seen for r in peers.values()), default=None)
+            elif rows:
+                first_seen = [row[2] for row in rows]
+                if self._oldest_first_seen is not None:
+                    first_seen.append(self._oldest_first_seen)
+                self._oldest_first_seen = min(first_seen)
+            self._peers = peers
+            self._version = version
+            self._loaded_at = now
+        return peers
+
+    def _invalidate(self):
+        self._loaded_at = float("-inf")
+
+    def __len__(self):
+        return len(self._snapshot())
+
+    def __contains__(self, username):
+        return username in self._snapshot()
+
+    def get(self, username):
+        return self._snapshot().get(username)
+
+    def touch(self, username, peer_address, now=None):
+        now = time.time() if now is None else now
+        get_connection().execute("""
+            INSERT INTO presence (username, peer_address, first_seen, last_seen) VALUES (?, ?, ?, ?)
+            ON CONFLICT (username) DO UPDATE SET peer_address = excluded.peer_address, last_seen = excluded.last_seen
+        """, (username, peer_address, now, now))
+
+        with self._lock:
+            record = self._peers.get(username)
+            if record is None:
+                self._invalidate()
+            else:
+                record.peer_address = peer_address
+                record.last_seen = now
+        return record
+
+    def expired(self, cutoff):
+        return get_connection().execute(
+            "SELECT username, last_seen FROM presence WHERE last_seen < ?", (cutoff,)
+        ).fetchall()
+
+    def discard(self, expired):
+        removed = []
+        with transaction() as conn:
+            for username, last_seen in expired:
+                cursor = conn.execute(
+                    "DELETE FROM presence WHERE username = ? AND last_seen = ?", (username, last_seen)
+                )
+                if cursor.rowcount:
+                    removed.append(username)
+        if removed:
+            self._invalidate()
+        return removed
+
+    def oldest_first_seen(self):
+        self._snapshot()
+        return self._oldest_first_seen
+
+    def active(self, timeout, now=None):
+        now = time.time() if now is None else now
+        return [
+            {"username": r.username, "address": r.peer_address}
+            for r in self._snapshot().values()
+            if now - r.last_seen < timeout
+        ]
+
+    def set_upload_rate(self, username, rate):
+        get_connection().execute("UPDATE presence SET upload_rate = ? WHERE username = ?", (rate, username))
+        record = self._peers.get(username)
+        if record is not None:
+            record.upload_rate = rate
+
+    def extend_grace(self, cutoff, min_last_seen):
+        get_connection().execute(
+            "UPDATE presence SET last_seen = ? WHERE last_seen >= ? AND last_seen < ?",
+            (min_last_seen, cutoff, min_last_seen)
+        )
+        self._invalidate()
+
+
+peers_online = SharedPresenceRegistry() if SHARED_STATE else PresenceRegistry()
+
+
+def save_presence(path=PRESENCE_FILE):
+    if SHARED_STATE:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"saved_at": time.time(), "peers": peers_online.export()}, f)
+    os.replace(tmp_path, path)
+
+
+def restore_presence(path=PRESENCE_FILE):
+    # Peers que expiraram enquanto o tracker estava fora entram com o
+    # last_seen antigo e saem na primeira limpeza, levando seus arquivos
+    if not SHARED_STATE:
+        try:
+            with open(path) as f:
+                peers_online.load(json.load(f)["peers"])
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[!] Snapshot de presença inválido em {path}: {e}")
+            return
+
+    now = time.time()
+    peers_online.extend_grace(now - HEARTBEAT_TIMEOUT, now - HEARTBEAT_TIMEOUT + RESTART_GRACE)
+    print(f"[*] Presença restaurada: {len(peers_online)} peer(s)")
+
+
+def presence_snapshot_loop():
+    while True:
+        time.sleep(PRESENCE_SNAPSHOT_INTERVAL)
+        try:
+            save_presence()
+        except OSError as e:
+            print(f"[!] Erro ao salvar presença em {PRESENCE_FILE}: {e}")
 
 
 def receive_heartbeat(username, peer_address):
-    if username not in peers_online:
-        peers_online[username] = {"peer_address": peer_address, "last_seen": time.time(), "first_seen": time.time()}
-    else:
-        peers_online[username].update({"peer_address": peer_address, "last_seen": time.time()})
+    previous = peers_online.get(username)
+    previous_address = previous.peer_address if previous else None
+    peers_online.touch(username, peer_address)
+    if peer_address != previous_address:
+        publish("peers", "peer_online", {"username": username, "address": peer_address})
 
 
 def list_active_peers():
-    now = time.time()
-    return [
-        {"username": u, "address": info["peer_address"]}
-        for u, info in peers_online.items()
-        if now - info["last_seen"] < HEARTBEAT_TIMEOUT
-    ]
+    return peers_online.active(HEARTBEAT_TIMEOUT)
+
+def _reported_number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not value >= 0:
+        return None
+    return value
+
+def record_upload(reporter, username, num_bytes, seconds):
+    # Taxa de upload observada por quem baixou deste peer (média móvel)
+    if not isinstance(username, str) or username == reporter:
+        return
+    num_bytes, seconds = _reported_number(num_bytes), _reported_number(seconds)
+    if not num_bytes or not seconds:
+        return
+    num_bytes = min(num_bytes, MAX_REPORTED_BYTES)
+    seconds = min(seconds, MAX_REPORTED_SECONDS)
+    record = peers_online.get(username)
+    if record is None:
+        return
+    rate = min(num_bytes / seconds, MAX_UPLOAD_RATE)
+    if record.upload_rate:
+        rate = UPLOAD_RATE_ALPHA * rate + (1 - UPLOAD_RATE_ALPHA) * record.upload_rate
+    peers_online.set_upload_rate(username, rate)
+
+def _batches(items, size=SQL_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 def cleanup_inactive_peers():
-    now = time.time()
-    to_remove = [u for u, data in peers_online.items()
-                 if now - data["last_seen"] > HEARTBEAT_TIMEOUT]
+    expired = peers_online.expired(time.time() - HEARTBEAT_TIMEOUT)
 
-    if not to_remove:
+    if not expired:
         return
 
-    with sqlite3.connect(DB_FILE) as conn:
-        for username in to_remove:
-            print(f"[!] Peer inativo detectado: {username} — removendo seus arquivos")
-            conn.execute("DELETE FROM file_peers WHERE username = ?", (username,))
+    usernames = [username for username, _ in expired]
+    print(f"[!] Peers inativos detectados: {', '.join(usernames)} — removendo seus arquivos")
 
-            orphaned_files = conn.execute("""
-                SELECT f.hash FROM files f
-                LEFT JOIN file_peers fp ON f.hash = fp.file_hash
-                WHERE fp.file_hash IS NULL
-            """).fetchall()
+    removed = []
+    with transaction() as conn:
+        for batch in _batches(usernames):
+            placeholders = ",".join("?" * len(batch))
+            candidates = [row[0] for row in conn.execute(
+                f"SELECT DISTINCT file_hash FROM file_peers WHERE username IN ({placeholders})", batch
+            )]
+            conn.execute(f"DELETE FROM file_peers WHERE username IN ({placeholders})", batch)
+            conn.execute(f"DELETE FROM chunk_bitfields WHERE username IN ({placeholders})", batch)
+            conn.execute(f"DELETE FROM peer_holdings WHERE username IN ({placeholders})", batch)
 
-            for (file_hash,) in orphaned_files:
-                print(f"    ⤷ Removendo metadados de arquivo órfão: {file_hash}")
-                conn.execute("DELETE FROM files WHERE hash = ?", (file_hash,))
+            # Só arquivos que esses peers tinham podem ter ficado órfãos
+            removed.extend(remove_orphaned_files(conn, candidates))
 
-            del peers_online[username]
-        conn.commit()
+        if removed:
+            print(f"    ⤷ Removidos metadados de {len(removed)} arquivo(s) órfão(s)")
+
+    # Só sai do registro depois do commit: se a transação falhar, os peers
+    # continuam expirados e a próxima limpeza tenta de novo
+    peers_online.discard(expired)
+
+    # Quem assina "peers" tira o usuário da lista de peers de cada arquivo
+    for username in usernames:
+        publish("peers", "peer_offline", {"username": username})
+    for file_hash in removed:
+        publish("files", "file_removed", {"hash": file_hash})
+
+def remove_orphaned_files(conn, candidates):
+    # Apaga de files os hashes em candidates que ficaram sem nenhum peer
+    removed = []
+    for hashes in _batches(candidates):
+        placeholders = ",".join("?" * len(hashes))
+        orphaned = [row[0] for row in conn.execute(f"""
+            SELECT hash FROM files
+            WHERE hash IN ({placeholders})
+            AND NOT EXISTS (SELECT 1 FROM file_peers fp WHERE fp.file_hash = files.hash)
+        """, hashes)]
+        if orphaned:
+            conn.execute(f"DELETE FROM files WHERE hash IN ({','.join('?' * len(orphaned))})", orphaned)
+            removed.extend(orphaned)
+    return removed
+
+def prune_tombstones(conn):
+    # Mantém só os tombstones mais recentes; quem pedir um delta anterior ao
+    # mais antigo que sobrou recebe o catálogo inteiro (reset)
+    row = conn.execute(
+        "SELECT version FROM file_tombstones ORDER BY version DESC LIMIT 1 OFFSET ?", (MAX_TOMBSTONES,)
+    ).fetchone()
+    if row:
+        conn.execute("DELETE FROM file_tombstones WHERE version <= ?", row)
+        conn.execute("UPDATE catalog_state SET min_delta_version = MAX(min_delta_version, ?)", row)
 
 def cleanup_loop():
+    last_prune = 0.0
     while True:
-        cleanup_inactive_peers()
+        try:
+            cleanup_inactive_peers()
+            if time.monotonic() - last_prune >= TOMBSTONE_PRUNE_INTERVAL:
+                with transaction() as conn:
+                    prune_tombstones(conn)
+                last_prune = time.monotonic()
+        except Exception as e:
+            print(f"[!] Erro na limpeza de peers inativos: {e}")
         time.sleep(CLEANUP_INTERVAL)
 
 
-def calculate_tier(username) -> tuple[str, int]:
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        SELECT username, SUM(size) as total_bytes
-        FROM files
-        JOIN file_peers ON files.hash = file_peers.file_hash
-        GROUP BY username
-    """)
-    bytes_por_peer = {row[0]: row[1] or 0 for row in cursor.fetchall()}
+def tier_scores(usernames) -> dict:
+    # Score de tier (0 a 1) de vários usuários com uma consulta por lote
+    conn = get_connection()
+    # user_bytes é mantida por triggers em files/file_peers
+    max_bytes = conn.execute("SELECT MAX(total_bytes) FROM user_bytes").fetchone()[0] or 0
 
-    max_bytes = max(bytes_por_peer.values()) if bytes_por_peer else 0
-    bytes_do_peer = bytes_por_peer.get(username, 0)
+    bytes_por_peer = {}
+    for batch in _batches(list(usernames)):
+        bytes_por_peer.update(conn.execute(
+            f"SELECT username, total_bytes FROM user_bytes WHERE username IN ({','.join('?' * len(batch))})", batch
+        ).fetchall())
 
-    tempos = {}
     now = int(time.time())
+    oldest = peers_online.oldest_first_seen()
+    max_uptime = now - oldest if oldest is not None else 0
 
-    for user, info in peers_online.items():
-        uptime = now - info["first_seen"]
-        tempos[user] = uptime
+    scores = {}
+    for username in usernames:
+        info = peers_online.get(username)
+        uptime_do_peer = now - info.first_seen if info else 0
 
-    max_uptime = max(tempos.values()) if tempos else 0
-    uptime_do_peer = tempos.get(username, 0)
+        proporcao_arquivos = (bytes_por_peer.get(username) or 0) / max_bytes if max_bytes > 0 else 0
+        proporcao_tempo = uptime_do_peer / max_uptime if max_uptime > 0 else 0
 
-    proporcao_arquivos = bytes_do_peer / max_bytes if max_bytes > 0 else 0
-    proporcao_tempo = uptime_do_peer / max_uptime if max_uptime > 0 else 0
+        scores[username] = (0.7 * proporcao_arquivos) + (0.3 * proporcao_tempo)
+    return scores
 
-    score = (0.7 * proporcao_arquivos) + (0.3 * proporcao_tempo)
+
+def calculate_tier(username) -> tuple[str, int]:
+    score = tier_scores([username])[username]
 
     if score >= 0.75:
         return "IV", 6
@@ -5,12 +5,13 @@ import sqlite3
 import random
 import subprocess
 import sys
+import time
 
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
-from peer.chunk_manager import split_file, hash_file
+from peer.chunk_manager import split_file, hash_file, encode_bitfield, save_file_info
 from tracker.files import register_file
 
 DB_FILE = "tracker.db"
@@ -27,7 +28,7 @@ def reset_db():
 
     print("[*] Limpando banco de dados...")
 
-    tables = ["users", "sessions", "files", "file_peers", "chat_rooms", "chat_members"]
+    tables = ["users", "sessions", "files", "file_peers", "user_bytes", "peer_holdings", "chunk_bitfields", "chat_rooms", "chat_members"]
 
     for table in tables:
         try:
@@ -77,6 +78,14 @@ def load_test_files():
     return filepaths
 
 
+def register_bitfield(cursor, file_hash, username, chunk_names, num_chunks):
+    indexes = [int(name.split("_", 1)[0]) for name in chunk_names]
+    cursor.execute("""
+        INSERT OR REPLACE INTO chunk_bitfields (file_hash, username, num_chunks, bitfield, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, (file_hash, username, num_chunks, encode_bitfield(indexes, num_chunks), int(time.time())))
+
+
 def register_files_and_chunks(filepaths):
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
@@ -105,7 +114,9 @@ def register_files_and_chunks(filepaths):
             INSERT OR IGNORE INTO file_peers (file_hash, username)
             VALUES (?, ?)
         """, (file_hash, "test1"))
+        save_file_info(chunk_dir_test1, filename, file_size)
         report[file_hash]["peers"]["test1"] = len(chunk_list)
+        register_bitfield(cursor, file_hash, "test1", chunk_list, len(chunk_list))
 
         chunk_dir_test2 = os.path.join(BASE_DIR, "test2", file_hash)
         os.makedirs(chunk_dir_test2, exist_ok=True)
@@ -115,6 +126,7 @@ def register_files_and_chunks(filepaths):
                 dst = os.path.join(chunk_dir_test2, chunk)
                 shutil.copyfile(src, dst)
         half_count = len([c for i, c in enumerate(chunk_list) if i % 2 == 0])
+        register_bitfield(cursor, file_hash, "test2", [c for i, c in enumerate(chunk_list) if i % 2 == 0], len(chunk_list))
         report[file_hash]["peers"]["test2"] = half_count
         if i % 2 == 0:
             cursor.execute("""
@@ -122,6 +134,7 @@ def register_files_and_chunks(filepaths):
                            OR IGNORE INTO file_peers (file_hash, username)
                         VALUES (?, ?)
                            """, (file_hash, "test2"))
+            save_file_info(chunk_dir_test2, filename, file_size)
 
         chunk_dir_test3 = os.path.join(BASE_DIR, "test3", file_hash)
         os.makedirs(chunk_dir_test3, exist_ok=True)
@@ -131,12 +144,14 @@ def register_files_and_chunks(filepaths):
             dst = os.path.join(chunk_dir_test3, chunk)
             shutil.copyfile(src, dst)
         report[file_hash]["peers"]["test3"] = len(selected)
+        register_bitfield(cursor, file_hash, "test3", selected, len(chunk_list))
         if i % 3 == 0:
             cursor.execute("""
                            INSERT
                            OR IGNORE INTO file_peers (file_hash, username)
                         VALUES (?, ?)
                            """, (file_hash, "test3"))
+            save_file_info(chunk_dir_test3, filename, file_size)
 
         report[file_hash]["peers"]["test4"] = 0
 
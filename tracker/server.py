@@ -1,163 +1,597 @@
+import asyncio
+import logging
+import os
+import random
+import signal
 import socket
+import sys
 import threading
-import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from peer.transport import hello_response, pack_frame, read_frame, write_frame
 from authentication import register_user, login_user
-from files import register_file, list_files
-from peers import cleanup_loop, receive_heartbeat, list_active_peers, calculate_tier
-from session import create_session, validate_session
-from database import init_db
+from files import register_file, list_files_page, search_files, check_holdings, sync_files
+from peers import presence_snapshot_loop, restore_presence, save_presence, cleanup_loop, receive_heartbeat, list_active_peers, calculate_tier, record_upload
+from session import create_session, validate_session, flush_sessions, load_revocations, session_maintenance_loop
+from database import SHARED_STATE, WORKERS, close_connection, init_db, transaction
+from events import TOPICS, event_log_loop, subscribe, unsubscribe
+from metrics import METRICS_FILE, metrics, metrics_dump_loop, dump_metrics
+from admission import RateLimiter, RequestScheduler, request_priority
+from chunk_maps import announce_chunks, get_chunk_holders, get_file_peers
 from chat_manager import create_chat_room, delete_chat_room, get_user_chats, add_member_to_chat, get_chat_members_with_addresses, remove_member_from_chat
 
 HOST = "0.0.0.0"
-PORT = 5000
+PORT = int(os.environ.get("TRACKER_PORT", 5000))
 
+# As chamadas ao SQLite são bloqueantes: rodam em um pool limitado de threads
+# enquanto o event loop cuida apenas das conexões.
+DB_WORKERS = 8
+LISTEN_BACKLOG = 1024
 
-def handle_client(conn, addr):
-    try:
-        with conn:
-            data = conn.recv(8192).decode()
-            request = json.loads(data)
-            print(f"[{addr[0]}:{addr[1]}] Request: {request}")
-            if request["type"] not in ["register", "login"]:
-                token = request.get("token")
-                username = validate_session(token)
-                if not username:
-                    conn.sendall(json.dumps({
-                        "status": "error",
-                        "message": "Token inválido ou expirado"
-                    }).encode())
-                    return
-
-            request = json.loads(data)
-            req_type = request.get("type")
-            success, msg = False, ""
-            extra_payload = {}
-
-            match req_type:
-                case "register":
-                    if not request.get("username") or not request.get("password"):
-                        success, msg = False, "Usuário e senha são obrigatórios"
-                    else:
-                        success, msg = register_user(request["username"], request["password"])
-
-                case "login":
-                    success, msg = login_user(request["username"], request["password"])
-                    if success:
-                        token = create_session(request["username"])
-                        extra_payload["token"] = token
-
-                case "register_file":
-                    token = request.get("token")
-                    username = validate_session(token)
-                    if not username:
-                        success, msg = False, "Token inválido ou expirado"
-                    else:
-                        register_file(
-                            request["hash"],
-                            request["filename"],
-                            request["size"],
-                            username
-                        )
-                        success, msg = True, "Arquivo registrado com sucesso."
-
-                case "list_files":
-                    files = list_files()
-                    success = True
-                    extra_payload["files"] = files
-
-                case "heartbeat":
-                    token = request.get("token")
-                    peer_port = request.get("port")
-                    username = validate_session(token)
-                    peer_address = f"{addr[0]}:{peer_port}"
-                    if username:
-                        receive_heartbeat(username, peer_address)
-                        success, msg = True, "heartbeat recebido"
-                    else:
-                        success, msg = False, "Token inválido ou ausente"
-                case "list_active_peers":
-                    peers = list_active_peers()
-                    success = True
-                    extra_payload["peers"] = peers
-                case "get_user_tier":
-                    token = request.get("token")
-                    username = validate_session(token)
-                    tier, max_connections = calculate_tier(username)
-                    success = True
-                    extra_payload["tier"] = tier
-                    extra_payload["max_connections"] = max_connections
-
-                case "create_chat_room":
-                    room_name = request.get("room_name")
-                    is_private = request.get("is_private", 0)
-                    invited_user = request.get("invited_user")
-                    if not room_name:
-                        success, msg = False, "O nome da sala é obrigatório."
-                    else:
-                        room_id, msg = create_chat_room(room_name, username, is_private, invited_user)
-                        if room_id:
-                            success = True
-                            extra_payload["room_id"] = room_id
-                        else:
-                            success = False
-                
-                case "list_my_chats":
-                    chats = get_user_chats(username)
-                    success = True
-                    extra_payload["chats"] = chats
-
-                case "add_chat_member":
-                    room_id = request.get("room_id")
-                    user_to_add = request.get("user_to_add")
-                    success, msg = add_member_to_chat(room_id, user_to_add, username)
-
-                case "remove_chat_member":
-                    room_id = request.get("room_id")
-                    user_to_remove = request.get("user_to_remove")
-                    success, msg = remove_member_from_chat(room_id, user_to_remove, username)
-
-                case "delete_chat_room":
-                    room_id = request.get("room_id")
-                    success, msg = delete_chat_room(room_id, username)
-                    if success:
-                        extra_payload["action"] = "close_window"
-
-                case "get_chat_members":
-                    room_id = request.get("room_id")
-                    members = get_chat_members_with_addresses(room_id)
+# Conexões longas: fecha as ociosas e limita quantas requisições de uma mesma
+# conexão podem estar em processamento ao mesmo tempo.
+IDLE_TIMEOUT = 300
+MAX_PIPELINED = 32
+# Acima disso novas conexões recebem um erro e são fechadas na hora
+MAX_CONNECTIONS = int(os.environ.get("TRACKER_MAX_CONNECTIONS", 10000))
+
+# Lotes: quantas sub-requisições cabem em um "batch", quais não podem ir
+# dentro de um (não usam o token do lote) e quais não escrevem no banco
+MAX_BATCH_SIZE = 100
+NOT_BATCHABLE = {"register", "login", "batch", "hello", "subscribe"}
+READ_ONLY_TYPES = {
+    "list_files", "search_files", "get_chunk_holders", "get_file_peers",
+    "list_active_peers", "get_user_tier", "list_my_chats", "get_chat_members",
+}
+
+# Tipos com métricas próprias; qualquer outro valor de "type" vem do cliente
+# e conta como "unknown", para não criar uma entrada por valor inventado
+REQUEST_TYPES = READ_ONLY_TYPES | {
+    "hello", "stats", "register", "login", "register_file", "heartbeat", "sync_files",
+    "announce_chunks", "report_transfers", "batch", "subscribe", "create_chat_room",
+    "add_chat_member", "remove_chat_member", "delete_chat_room",
+}
+
+# Log por requisição só em DEBUG e só para uma amostra (TRACKER_LOG_SAMPLE);
+# os números completos ficam em metrics (requisição "stats" e o arquivo
+# TRACKER_METRICS_FILE)
+LOG_LEVEL = os.environ.get("TRACKER_LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.environ.get("TRACKER_LOG_SAMPLE", 0.01))
+log = logging.getLogger("tracker")
+
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="tracker-db")
+rate_limiter = RateLimiter()
+# Criado em serve(), dentro do event loop
+scheduler = None
+# Índice deste processo entre os TRACKER_WORKERS
+worker_index = 0
+# Conexões abertas (writer -> task), para fechá-las ao encerrar
+client_tasks = {}
+SHUTDOWN_TIMEOUT = 5
+# Espera antes de recriar um worker que morreu
+WORKER_RESTART_DELAY = 1
+
+
+def process_request(request, addr):
+    username = None
+    if request["type"] not in ["register", "login"]:
+        token = request.get("token")
+        username = validate_session(token)
+        if not username:
+            return {
+                "status": "error",
+                "message": "Token inválido ou expirado",
+                # Para clientes distinguirem de recusas temporárias
+                "code": "invalid_token",
+            }
+
+    return dispatch_request(request, username, addr)
+
+
+def process_batch(requests, username, addr):
+    # Todas as sub-requisições rodam em uma única transação (um BEGIN/COMMIT
+    # e um fsync para o lote todo). Cada uma fica em seu próprio SAVEPOINT:
+    # se uma falhar, só o que ela fez é desfeito e o resto do lote segue.
+    # Entradas que não são objetos com "type" em texto recebem erro só para si
+    valid = [isinstance(r, dict) and isinstance(r.get("type"), str) for r in requests]
+    write = any(ok and r["type"] not in READ_ONLY_TYPES for ok, r in zip(valid, requests))
+    responses = []
+    with transaction(write=write):
+        for ok, sub_request in zip(valid, requests):
+            if not ok:
+                response = {"status": "error", "message": "Requisição inválida."}
+                if isinstance(sub_request, dict) and "id" in sub_request:
+                    response["id"] = sub_request["id"]
+                responses.append(response)
+                continue
+            if sub_request["type"] in NOT_BATCHABLE:
+                response = {"status": "error", "message": "Requisição não permitida em lote."}
+            else:
+                try:
+                    with transaction():
+                        response = dispatch_request(sub_request, username, addr)
+                except Exception as e:
+                    response = {"status": "error", "message": str(e)}
+            if "id" in sub_request:
+                response["id"] = sub_request["id"]
+            responses.append(response)
+    return responses
+
+
+def dispatch_request(request, username, addr):
+    req_type = request.get("type")
+    success, msg = False, ""
+    extra_payload = {}
+
+    match req_type:
+        case "register":
+            if not request.get("username") or not request.get("password"):
+                success, msg = False, "Usuário e senha são obrigatórios"
+            else:
+                success, msg = register_user(request["username"], request["password"])
+
+        case "login":
+            success, msg = login_user(request["username"], request["password"])
+            if success:
+                token = create_session(request["username"])
+                extra_payload["token"] = token
+
+        case "register_file":
+            register_file(
+                request["hash"],
+                request["filename"],
+                request["size"],
+                username
+            )
+            success, msg = True, "Arquivo registrado com sucesso."
+
+        case "list_files":
+            page = list_files_page(
+                request.get("cursor"),
+                request.get("limit"),
+                request.get("since_version"),
+                request.get("fields")
+            )
+            success = True
+            extra_payload.update(page)
+
+        case "search_files":
+            query = request.get("query", "")
+            if not query.strip():
+                success, msg = False, "O termo de busca é obrigatório."
+            else:
+                success = True
+                extra_payload["files"] = search_files(query, request.get("limit"))
+
+        case "heartbeat":
+            peer_port = request.get("port")
+            peer_address = f"{addr[0]}:{peer_port}"
+            receive_heartbeat(username, peer_address)
+            success, msg = True, "heartbeat recebido"
+            # Peer que manda o digest dos seus arquivos é avisado se o
+            # tracker perdeu algum (limpeza de inativos, reinício)
+            holdings = request.get("holdings")
+            if holdings:
+                extra_payload["sync_files"] = not check_holdings(username, holdings.get("count"), holdings.get("digest"))
+
+        case "sync_files":
+            files = request.get("files")
+            remove = request.get("remove", [])
+            if not isinstance(files, list) or not all(
+                isinstance(f, dict) and f.get("hash") and f.get("filename") and isinstance(f.get("size"), int)
+                for f in files
+            ):
+                success, msg = False, "Informe a lista de arquivos (hash, filename e size)."
+            elif not isinstance(remove, list) or not all(isinstance(h, str) for h in remove):
+                success, msg = False, "remove deve ser uma lista de hashes."
+            else:
+                success, msg = True, "Arquivos sincronizados."
+                extra_payload.update(sync_files(username, files, remove))
+        case "announce_chunks":
+            if not request.get("hash") or (request.get("bitfield") is None and request.get("have") is None):
+                success, msg = False, "Informe o hash e o bitfield ou os chunks novos."
+            else:
+                success, msg = announce_chunks(
+                    username,
+                    request["hash"],
+                    request.get("num_chunks"),
+                    request.get("bitfield"),
+                    request.get("have")
+                )
+
+        case "get_chunk_holders":
+            holders = get_chunk_holders(request.get("hash"))
+            success = True
+            extra_payload["holders"] = holders
+
+        case "get_file_peers":
+            if not request.get("hash"):
+                success, msg = False, "O hash do arquivo é obrigatório."
+            else:
+                success = True
+                extra_payload["peers"] = get_file_peers(request["hash"], request.get("limit"), username)
+
+        case "report_transfers":
+            transfers = request.get("transfers")
+            for transfer in transfers if isinstance(transfers, list) else []:
+                if isinstance(transfer, dict):
+                    record_upload(username, transfer.get("username"), transfer.get("bytes"), transfer.get("seconds"))
+            success, msg = True, "Transferências registradas."
+
+        case "batch":
+            requests = request.get("requests")
+            if not isinstance(requests, list) or not requests:
+                success, msg = False, "Informe a lista de requisições do lote."
+            elif len(requests) > MAX_BATCH_SIZE:
+                success, msg = False, f"Lote limitado a {MAX_BATCH_SIZE} requisições."
+            else:
+                success = True
+                extra_payload["responses"] = process_batch(requests, username, addr)
+
+        case "subscribe":
+            # A assinatura em si é criada em handle_client, que conhece a conexão
+            topics = request.get("topics") or list(TOPICS)
+            invalid = [t for t in topics if t not in TOPICS]
+            if invalid:
+                success, msg = False, f"Tópicos inválidos: {', '.join(invalid)}"
+            else:
+                success, msg = True, "Assinatura ativa."
+                extra_payload["username"] = username
+                extra_payload["topics"] = topics
+
+        case "list_active_peers":
+            peers = list_active_peers()
+            success = True
+            extra_payload["peers"] = peers
+        case "get_user_tier":
+            tier, max_connections = calculate_tier(username)
+            success = True
+            extra_payload["tier"] = tier
+            extra_payload["max_connections"] = max_connections
+
+        case "create_chat_room":
+            room_name = request.get("room_name")
+            is_private = request.get("is_private", 0)
+            invited_user = request.get("invited_user")
+            if not room_name:
+                success, msg = False, "O nome da sala é obrigatório."
+            else:
+                room_id, msg = create_chat_room(room_name, username, is_private, invited_user)
+                if room_id:
                     success = True
-                    extra_payload["members"] = members
+                    extra_payload["room_id"] = room_id
+                else:
+                    success = False
+        
+        case "list_my_chats":
+            chats = get_user_chats(username)
+            success = True
+            extra_payload["chats"] = chats
+
+        case "add_chat_member":
+            room_id = request.get("room_id")
+            user_to_add = request.get("user_to_add")
+            success, msg = add_member_to_chat(room_id, user_to_add, username)
+
+        case "remove_chat_member":
+            room_id = request.get("room_id")
+            user_to_remove = request.get("user_to_remove")
+            success, msg = remove_member_from_chat(room_id, user_to_remove, username)
+
+        case "delete_chat_room":
+            room_id = request.get("room_id")
+            success, msg = delete_chat_room(room_id, username)
+            if success:
+                extra_payload["action"] = "close_window"
+
+        case "get_chat_members":
+            room_id = request.get("room_id")
+            members = get_chat_members_with_addresses(room_id)
+            success = True
+            extra_payload["members"] = members
 
-                case _:
-                    success, msg = False, "Requisição inválida."
+        case _:
+            success, msg = False, "Requisição inválida."
 
+    response = {
+        "status": "success" if success else "error",
+        "message": msg
+    }
+    response.update(extra_payload)
+    return response
+
+
+def timed_process_request(request, addr):
+    start = time.perf_counter()
+    response = process_request(request, addr)
+    return response, time.perf_counter() - start
+
+
+async def execute_request(request, addr):
+    # Devolve a resposta e o tempo gasto em process_request (no pool do banco)
+    db_time = 0.0
+    try:
+        # Admissão: limites por cliente e por tipo, depois a fila do banco.
+        # As recusas são decididas aqui no event loop, sem tocar no banco.
+        priority = request_priority(request.get("type"))
+        retry_after = None if request.get("type") == "hello" else rate_limiter.check(request, addr)
+        if request.get("type") == "hello":
+            response = hello_response(request)
+        elif retry_after is not None:
+            metrics.request_rejected("rate_limit")
             response = {
-                "status": "success" if success else "error",
-                "message": msg
+                "status": "error",
+                "message": "Limite de requisições excedido. Tente novamente em instantes.",
+                "retry_after": round(retry_after, 2),
             }
-            response.update(extra_payload)
-            print(f"[{addr[0]}:{addr[1]}] Response: {response}")
-            conn.sendall(json.dumps(response).encode()) 
-
+        elif request.get("type") == "stats":
+            # Com vários processos, cada um responde só pelas suas conexões
+            response = {"status": "success", "message": "", "stats": {
+                **metrics.snapshot(), "queued": scheduler.queued, "worker": worker_index, "pid": os.getpid(),
+            }}
+        elif scheduler.overloaded(priority):
+            metrics.request_rejected("overload")
+            response = {
+                "status": "error",
+                "message": "Tracker sobrecarregado. Tente novamente em instantes.",
+                "retry_after": 1,
+            }
+        else:
+            response, db_time = await scheduler.submit(priority, timed_process_request, request, addr)
     except Exception as e:
-        conn.sendall(json.dumps({"status": "error", "message": str(e)}).encode())
+        log.warning("[%s:%s] Erro em %s: %s", addr[0], addr[1], request.get("type"), e, exc_info=True)
+        response = {"status": "error", "message": str(e)}
+
+    if "id" in request:
+        response["id"] = request["id"]
+    return response, db_time
+
+
+def log_request(addr, request, response, elapsed, size):
+    # Só um resumo de uma amostra das requisições; o payload inteiro
+    # (list_files pode ter milhares de arquivos) nunca vai para o log
+    if log.isEnabledFor(logging.DEBUG) and random.random() < LOG_SAMPLE_RATE:
+        log.debug(
+            "[%s:%s] %s -> %s (%.2f ms, %d bytes) %s",
+            addr[0], addr[1], request.get("type"), response.get("status"),
+            elapsed * 1000, size, response.get("message", ""),
+        )
+
+
+async def handle_client(reader, writer):
+    addr = writer.get_extra_info("peername")
+    write_lock = asyncio.Lock()
+    pipeline = asyncio.Semaphore(MAX_PIPELINED)
+    tasks = set()
+    subscription = None
+    push_task = None
+
+    async def push_events(events, codec):
+        # Eventos vão pela mesma conexão, sem id, intercalados às respostas
+        try:
+            while True:
+                event = await events.get()
+                async with write_lock:
+                    write_frame(writer, event, codec)
+                    await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def respond(request, codec):
+        nonlocal subscription, push_task
+        start = time.perf_counter()
+        metrics.request_started()
+        response, db_time, serialize_time, data = {}, 0.0, 0.0, b""
+        try:
+            response, db_time = await execute_request(request, addr)
+            subscribed = request.get("type") == "subscribe" and response.get("status") == "success"
+            if subscribed:
+                if subscription:
+                    unsubscribe(subscription)
+                    if push_task:
+                        push_task.cancel()
+                # Eventos publicados a partir daqui ficam na fila até a
+                # resposta do subscribe ser enviada
+                subscription = subscribe(response["username"], response["topics"], asyncio.get_running_loop())
+            encode_start = time.perf_counter()
+            data = pack_frame(response, codec)
+            serialize_time = time.perf_counter() - encode_start
+            async with write_lock:
+                writer.write(data)
+                await writer.drain()
+            if subscribed:
+                push_task = asyncio.create_task(push_events(subscription.queue, codec))
+        except ConnectionError:
+            pass
+        finally:
+            pipeline.release()
+            elapsed = time.perf_counter() - start
+            req_type = request.get("type")
+            metrics.request_finished(
+                req_type if isinstance(req_type, str) and req_type in REQUEST_TYPES else "unknown", response.get("status") == "error",
+                elapsed, db_time, serialize_time, len(data),
+            )
+            log_request(addr, request, response, elapsed, len(data))
+
+    if metrics.connections >= MAX_CONNECTIONS:
+        metrics.request_rejected("connections")
+        try:
+            write_frame(writer, {"status": "error", "message": "Tracker sobrecarregado. Tente novamente em instantes."})
+            await writer.drain()
+            writer.close()
+        except ConnectionError:
+            pass
+        return
+
+    metrics.connection_opened()
+    client_tasks[writer] = asyncio.current_task()
+    try:
+        while True:
+            # Conexões com assinatura ficam abertas mesmo sem requisições
+            timeout = None if subscription else IDLE_TIMEOUT
+            try:
+                request, codec = await asyncio.wait_for(read_frame(reader), timeout)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                break
+
+            if not isinstance(request, dict):
+                # Frame válido, mas o corpo não é um objeto: não há tipo nem id
+                metrics.request_rejected("invalid")
+                try:
+                    async with write_lock:
+                        write_frame(writer, {"status": "error", "message": "Requisição inválida."}, codec)
+                        await writer.drain()
+                except ConnectionError:
+                    break
+                continue
+
+            await pipeline.acquire()
+            # Requisições com id podem ser respondidas fora de ordem; as sem id
+            # (clientes antigos) são atendidas uma de cada vez, na ordem.
+            if "id" in request:
+                task = asyncio.create_task(respond(request, codec))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            else:
+                await respond(request, codec)
+
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        metrics.connection_closed()
+        if subscription:
+            unsubscribe(subscription)
+        if push_task:
+            push_task.cancel()
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except Exception:
+            pass
+        finally:
+            client_tasks.pop(writer, None)
+
+
+async def serve():
+    global scheduler
+    scheduler = RequestScheduler(db_executor, DB_WORKERS)
+    scheduler.start()
+
+    # Com vários workers todos escutam na mesma porta (SO_REUSEPORT) e o
+    # kernel distribui as conexões entre eles
+    server = await asyncio.start_server(
+        handle_client, HOST, PORT, backlog=LISTEN_BACKLOG, reuse_address=True, reuse_port=WORKERS > 1
+    )
+    log.info("[*] Tracker ativo em %s:%s (worker %d, pid %d)", HOST, PORT, worker_index, os.getpid())
+
+    # SIGTERM (do processo principal ou do sistema) para de aceitar conexões
+    # e encerra o loop normalmente, passando pelo finally de run_worker
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, lambda: stopped.done() or stopped.set_result(None))
+    except (NotImplementedError, AttributeError):
+        pass
+    async with server:
+        await stopped
+        server.close()
+        # Derruba as conexões para que cada handle_client saia pelo próprio
+        # finally em vez de ser cancelado no meio
+        tasks = list(client_tasks.values())
+        for writer in list(client_tasks):
+            writer.transport.abort()
+        if tasks:
+            await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+
+
+def run_worker(index):
+    global worker_index
+    worker_index = index
+    metrics_file = f"{METRICS_FILE}.{index}" if WORKERS > 1 else METRICS_FILE
+    # Cada worker (inclusive um reiniciado) parte das revogações já gravadas
+    load_revocations()
+
+    # A limpeza de peers inativos é global: um worker só cuida dela
+    if index == 0:
+        threading.Thread(target=cleanup_loop, daemon=True).start()
+    if SHARED_STATE:
+        threading.Thread(target=event_log_loop, args=(index == 0,), daemon=True).start()
+    else:
+        threading.Thread(target=presence_snapshot_loop, daemon=True).start()
+    threading.Thread(target=session_maintenance_loop, daemon=True).start()
+    threading.Thread(target=metrics_dump_loop, args=(metrics_file,), daemon=True).start()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db_executor.shutdown(wait=False)
+        flush_sessions()
+        save_presence()
+        dump_metrics(metrics_file)
+
+
+def _spawn_worker(index):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(index)
+        except SystemExit as e:
+            code = e.code or 0
+        except BaseException:
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
 
 
 def start_server():
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(message)s")
     init_db()
+    restore_presence()
 
-    threading.Thread(target=cleanup_loop, daemon=True).start()
+    if WORKERS <= 1:
+        run_worker(0)
+        return
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        log.warning("[!] Sistema sem fork/SO_REUSEPORT: rodando um único worker")
+        run_worker(0)
+        return
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT))
-        s.listen()
-        print(f"[*] Tracker ativo em {HOST}:{PORT}")
+    # Conexões SQLite não podem atravessar o fork
+    close_connection()
+
+    workers = {_spawn_worker(index): index for index in range(WORKERS)}
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
         while True:
-            conn, addr = s.accept()
-            threading.Thread(
-                target=handle_client, args=(conn, addr), daemon=True
-            ).start()
+            pid, status = os.wait()
+            index = workers.pop(pid, None)
+            if index is None:
+                continue
+            log.warning("[!] Worker %d (pid %d) terminou com status %d; reiniciando", index, pid, status)
+            time.sleep(WORKER_RESTART_DELAY)
+            workers[_spawn_worker(index)] = index
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
 
 
 if __name__ == "__main__":
@@ -1,37 +1,185 @@
-import sqlite3
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import secrets
+import threading
 import uuid
 import time
-from database import DB_FILE
+from database import get_connection, transaction
+from events import broadcast, on_broadcast
 
 SESSION_TIMEOUT = 3600
+SESSION_FLUSH_INTERVAL = 30
+
+# "db": tokens uuid4 guardados na tabela sessions (padrão).
+# "signed": tokens assinados com HMAC que carregam usuário e validade e são
+# verificados sem acessar o banco. Todos os trackers que compartilham o
+# TRACKER_SESSION_SECRET aceitam os tokens uns dos outros.
+SESSION_MODE = os.environ.get("TRACKER_SESSION_MODE", "db")
+SIGNED_TOKEN_TTL = int(os.environ.get("TRACKER_SIGNED_TOKEN_TTL", 12 * 3600))
+SESSION_SECRET = os.environ.get("TRACKER_SESSION_SECRET", "").encode() or secrets.token_bytes(32)
+
+# Cache token -> [username, last_seen]. Validar uma sessão é só uma consulta
+# ao dicionário; o last_seen vai para a tabela sessions em lotes.
+_sessions = {}
+_dirty = set()
+_lock = threading.Lock()
+
+# Tokens assinados revogados antes de expirar: nonce -> expiração. A lista
+# fica também na tabela revoked_tokens, recarregada quando o processo sobe,
+# e os outros processos do tracker são avisados pelo event_log.
+_revoked = {}
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _sign(payload: bytes) -> bytes:
+    return hmac.new(SESSION_SECRET, payload, hashlib.sha256).digest()
+
+def _parse_signed_token(token):
+    try:
+        payload_b64, signature_b64 = token.split(".")
+        payload = _b64decode(payload_b64)
+        signature = _b64decode(signature_b64)
+    except (ValueError, binascii.Error):
+        return None
+    if not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    nonce, expires, username = payload.decode().split(":", 2)
+    return nonce, int(expires), username
+
+def create_signed_session(username):
+    expires = int(time.time()) + SIGNED_TOKEN_TTL
+    payload = f"{secrets.token_hex(8)}:{expires}:{username}".encode()
+    return f"{_b64encode(payload)}.{_b64encode(_sign(payload))}"
+
+def validate_signed_session(token):
+    parsed = _parse_signed_token(token)
+    if not parsed:
+        return None
+    nonce, expires, username = parsed
+    if expires < time.time():
+        return None
+    with _lock:
+        if nonce in _revoked:
+            return None
+    return username
 
 def create_session(username):
+    if SESSION_MODE == "signed":
+        return create_signed_session(username)
+
     token = str(uuid.uuid4())
     now = int(time.time())
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute('''
-            INSERT INTO sessions (token, username, last_seen)
-            VALUES (?, ?, ?)
-        ''', (token, username, now))
+    get_connection().execute('''
+        INSERT INTO sessions (token, username, last_seen)
+        VALUES (?, ?, ?)
+    ''', (token, username, now))
+    with _lock:
+        _sessions[token] = [username, now]
     return token
 
 def validate_session(token):
+    if not token:
+        return None
+    if SESSION_MODE == "signed":
+        return validate_signed_session(token)
     now = int(time.time())
-    with sqlite3.connect(DB_FILE) as conn:
-        cur = conn.execute('''
+
+    with _lock:
+        entry = _sessions.get(token)
+
+    if entry is None:
+        # Sessões criadas antes de um restart só existem no banco
+        row = get_connection().execute('''
             SELECT username, last_seen FROM sessions
             WHERE token = ?
-        ''', (token,))
-        row = cur.fetchone()
+        ''', (token,)).fetchone()
         if not row:
             return None
-        username, last_seen = row
+        with _lock:
+            entry = _sessions.setdefault(token, [row[0], row[1]])
+
+    with _lock:
+        username, last_seen = entry
         if now - last_seen > SESSION_TIMEOUT:
-            conn.execute('DELETE FROM sessions WHERE token = ?', (token,))
+            _sessions.pop(token, None)
+            _dirty.discard(token)
             return None
-        conn.execute('UPDATE sessions SET last_seen = ? WHERE token = ?', (now, token))
-        return username
+        entry[1] = now
+        _dirty.add(token)
+    return username
 
 def invalidate_session(token):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute('DELETE FROM sessions WHERE token = ?', (token,))
+    if SESSION_MODE == "signed":
+        parsed = _parse_signed_token(token)
+        if parsed:
+            nonce, expires, _ = parsed
+            _revoke({"nonce": nonce, "expires": expires})
+            get_connection().execute(
+                'INSERT OR REPLACE INTO revoked_tokens (nonce, expires) VALUES (?, ?)', (nonce, expires)
+            )
+            broadcast("token_revoked", {"nonce": nonce, "expires": expires})
+        return
+
+    _forget_session({"token": token})
+    get_connection().execute('DELETE FROM sessions WHERE token = ?', (token,))
+    # Os outros processos do tracker podem ter o token no cache
+    broadcast("session_invalidated", {"token": token})
+
+def _forget_session(data):
+    with _lock:
+        _sessions.pop(data["token"], None)
+        _dirty.discard(data["token"])
+
+def _revoke(data):
+    with _lock:
+        _revoked[data["nonce"]] = data["expires"]
+
+on_broadcast("session_invalidated", _forget_session)
+on_broadcast("token_revoked", _revoke)
+
+def load_revocations():
+    rows = get_connection().execute(
+        'SELECT nonce, expires FROM revoked_tokens WHERE expires >= ?', (int(time.time()),)
+    ).fetchall()
+    with _lock:
+        _revoked.update(rows)
+
+def flush_sessions():
+    with _lock:
+        updates = [(_sessions[token][1], token) for token in _dirty if token in _sessions]
+        _dirty.clear()
+
+    if updates:
+        with transaction() as conn:
+            conn.executemany('UPDATE sessions SET last_seen = ? WHERE token = ?', updates)
+
+def purge_expired_sessions():
+    now = int(time.time())
+    cutoff = now - SESSION_TIMEOUT
+    with _lock:
+        for nonce in [n for n, expires in _revoked.items() if expires < now]:
+            del _revoked[nonce]
+        expired = [token for token, (_, last_seen) in _sessions.items() if last_seen < cutoff]
+        for token in expired:
+            del _sessions[token]
+            _dirty.discard(token)
+    get_connection().execute('DELETE FROM sessions WHERE last_seen < ?', (cutoff,))
+    get_connection().execute('DELETE FROM revoked_tokens WHERE expires < ?', (now,))
+
+def session_maintenance_loop():
+    while True:
+        time.sleep(SESSION_FLUSH_INTERVAL)
+        try:
+            # O flush vem antes do purge para não apagar sessões ativas cujo
+            # last_seen ainda não chegou ao banco
+            flush_sessions()
+            purge_expired_sessions()
+        except Exception as e:
+            print(f"[!] Erro na manutenção de sessões: {e}")